@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# Micro-benchmark of the lookups done while building the hierarchy and
+# converting pages: historical-version membership, and finding an
+# attachment of a page by name. Compares the old list scans with the
+# set and dict indexes extract.py now uses.
+import argparse
+import timeit
+
+class Attachment:
+    def __init__(self, id, title):
+        self.id = id
+        self.title = title
+
+def find_in_list(link_name, attaches):
+    for a in attaches:
+        if (a.title == link_name):
+            return a.id
+    return '0'
+
+def find_in_dict(link_name, attachByName):
+    if link_name in attachByName:
+        return attachByName[link_name].id
+    return '0'
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmark of the extract.py lookup indexes')
+    parser.add_argument('--pages', type=int, default=20000)
+    parser.add_argument('--history', type=int, default=10,
+                        help='historical versions per page')
+    parser.add_argument('--attachments', type=int, default=50,
+                        help='attachments per page')
+    args = parser.parse_args()
+
+    ids = [str(i) for i in range(args.pages * (args.history + 1))]
+    latest = ids[:args.pages]
+    outDatedList = ids[args.pages:]
+    outDatedSet = set(outDatedList)
+    # the hierarchy pass checks every latest page, none of which are outdated
+    n = min(200, len(latest))
+    sample = latest[:n]
+    t_list = timeit.timeit(lambda: [p in outDatedList for p in sample], number=1) / n
+    t_set = timeit.timeit(lambda: [p in outDatedSet for p in latest], number=1) / len(latest)
+    print('outdated check, %d historical ids:' % len(outDatedList))
+    print('  list  %10.3f us/lookup  (~%.1fs for all pages)' % (t_list * 1e6, t_list * args.pages))
+    print('  set   %10.3f us/lookup  (~%.4fs for all pages)' % (t_set * 1e6, t_set * args.pages))
+
+    attaches = [Attachment(str(i), 'file_%d.png' % i) for i in range(args.attachments)]
+    attachByName = {}
+    for a in reversed(attaches):
+        attachByName[a.title] = a
+    names = [a.title for a in attaches] + ['missing.png']
+    reps = 2000
+    t_list = timeit.timeit(lambda: [find_in_list(x, attaches) for x in names], number=reps)
+    t_dict = timeit.timeit(lambda: [find_in_dict(x, attachByName) for x in names], number=reps)
+    print('attachment lookup, %d attachments per page:' % args.attachments)
+    print('  list  %10.3f us/lookup' % (t_list / reps / len(names) * 1e6))
+    print('  dict  %10.3f us/lookup' % (t_dict / reps / len(names) * 1e6))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# Benchmark the native renderer's macro fragment cache on pages that
+# share their code, info and panel blocks, as pages copied from a
+# template do: rewrite() and render() every page without the cache and
+# with it, and check that the markup is the same.
+#
+#   python3 benchmarks/bench_macro_cache.py [--pages N] [--blocks N] [--distinct N] [--size N]
+import argparse
+import os
+import random
+import sys
+import time
+
+from corpus import extract
+
+WORDS = 'kernel proof capability thread scheduler interrupt device driver cache page table'.split()
+
+def block(rng, n, size):
+    words = ' '.join(rng.choice(WORDS) for _ in range(size // 8))
+    kind = n % 3
+    if kind == 0:
+        code = '\n'.join('    x%d = f(x%d, "%s");' % (i, i, rng.choice(WORDS)) for i in range(size // 30))
+        return ('<ac:structured-macro ac:name="code"><ac:parameter ac:name="language">c</ac:parameter>'
+                '<ac:plain-text-body><![CDATA[%s]]></ac:plain-text-body></ac:structured-macro>' % code)
+    if kind == 1:
+        return ('<ac:structured-macro ac:name="info"><ac:rich-text-body><p>%s <strong>%s</strong></p>'
+                '<ul><li>%s</li><li>%s</li></ul></ac:rich-text-body></ac:structured-macro>' % (
+                    words, n, words[:40], words[40:80]))
+    return ('<ac:structured-macro ac:name="panel"><ac:parameter ac:name="title">Block %d</ac:parameter>'
+            '<ac:rich-text-body><p>%s</p><table><tbody><tr><th>a</th><th>b</th></tr>'
+            '<tr><td>%s</td><td>_%s_</td></tr></tbody></table></ac:rich-text-body>'
+            '</ac:structured-macro>' % (n, words, words[:20], words[20:40]))
+
+def make_pages(args):
+    rng = random.Random(1)
+    shared = [block(rng, n, args.size) for n in range(args.distinct)]
+    pages = []
+    for i in range(args.pages):
+        parts = ['<p>Page %d: %s</p>' % (i, ' '.join(rng.choice(WORDS) for _ in range(30)))]
+        parts.extend(rng.choice(shared) for _ in range(args.blocks))
+        page = extract.Page(str(900000 + i), None, '1', str(900000 + i), 'Page %d' % i, 'current', [])
+        page.path = ':oldwiki:page_%d' % i
+        pages.append((page, ''.join(parts)))
+    return pages
+
+def run(pages):
+    out = []
+    start = time.perf_counter()
+    for page, body in pages:
+        out.append(extract.renderer.render(extract.rewrite(body, page)))
+    return time.perf_counter() - start, out
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the macro fragment cache')
+    parser.add_argument('--pages', type=int, default=300)
+    parser.add_argument('--blocks', type=int, default=20, help='macros per page')
+    parser.add_argument('--distinct', type=int, default=30, help='different macros in all')
+    parser.add_argument('--size', type=int, default=600, help='bytes of text per macro')
+    parser.add_argument('--cache', type=int, default=1000, help='fragments to keep')
+    args = parser.parse_args()
+
+    pages = make_pages(args)
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        extract.fragmentCache = None
+        plain, expected = run(pages)
+        extract.fragmentCache = extract.FragmentCache(args.cache)
+        cached, got = run(pages)
+    finally:
+        sys.stdout = stdout
+    assert got == expected, 'the cache changed the markup'
+    cache = extract.fragmentCache
+    print('%d pages of %d macros, %d distinct' % (args.pages, args.blocks, args.distinct))
+    print('  no cache   %6.2fms/page' % (plain / args.pages * 1000))
+    print('  cache      %6.2fms/page (%d hits, %d misses)' % (
+        cached / args.pages * 1000, cache.hits, cache.misses))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# Per-page parse time of each BeautifulSoup backend extract.py can use
+# (--parser), on the largest page bodies of an export, and the cost of
+# the small fragment soups made by macros, TOCs and attachment indexes.
+#
+#   cd <export>; python3 <repo>/benchmarks/bench_parsers.py [--body-store FILE]
+import argparse
+import warnings
+
+from corpus import extract, largest_bodies, best_of
+from bs4 import BeautifulSoup
+
+parsers = ['html.parser', 'lxml', 'lxml-xml']
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark BeautifulSoup parsers on page bodies')
+    parser.add_argument('--pages', type=int, default=50, help='how many of the largest bodies')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--body-store', metavar='FILE', help='read bodies from a BodyStore')
+    args = parser.parse_args()
+
+    bodies = largest_bodies(args.pages, args.body_store)
+    totals = dict((p, 0.0) for p in parsers)
+    print('%10s %8s' % ('body id', 'KiB') + ''.join('%14s' % p for p in parsers))
+    for size, id, body in bodies:
+        row = '%10s %8.1f' % (id, size / 1024)
+        for p in parsers:
+            extract.soupParser = p
+            t = best_of(args.repeat, lambda: extract.parse_storage(body))
+            totals[p] += t
+            row += '%12.2fms' % (t * 1000)
+        print(row)
+    if bodies:
+        print('%19s' % 'mean per page' + ''.join('%12.2fms' % (totals[p] / len(bodies) * 1000)
+                                                 for p in parsers))
+
+    n = 10000
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        guessed = best_of(args.repeat, lambda: [BeautifulSoup('') for _ in range(n)])
+    named = best_of(args.repeat, lambda: [extract.new_soup() for _ in range(n)])
+    print('fragment soup: BeautifulSoup(\'\') %.1fus, new_soup() %.1fus' % (
+        guessed / n * 1e6, named / n * 1e6))
+
+if __name__ == '__main__':
+    main()
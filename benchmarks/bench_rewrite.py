@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# Benchmark the rewrite pass of convert() on the largest page bodies of
+# an export: the seven soup.find_all() traversals convert() used to make,
+# against the single collect_rewrites() walk that replaced them, and
+# the whole convert() for reference.
+#
+#   cd <export>; python3 <repo>/benchmarks/bench_rewrite.py [--body-store FILE]
+import argparse
+import os
+import sys
+
+from corpus import extract, largest_bodies, best_of
+from bs4 import BeautifulSoup
+
+def legacy_traversals(soup):
+    return [soup.find_all('ri:user'),
+            soup.find_all('ri:attachment'),
+            soup.find_all('ri:page'),
+            soup.find_all('ac:task-list'),
+            soup.find_all(attrs = {"class": "emoticon"}),
+            soup.find_all('ac:emoticon'),
+            soup.find_all('ac:structured-macro')]
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the convert() rewrite pass')
+    parser.add_argument('--pages', type=int, default=10, help='how many of the largest bodies')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--body-store', metavar='FILE', help='read bodies from a BodyStore')
+    args = parser.parse_args()
+
+    bodies = largest_bodies(args.pages, args.body_store)
+    page = extract.Page('bench', None, '1', '0', 'Benchmark', 'current', [])
+    page.pathname = 'pages/current/benchmark'
+    page.path = ':oldwiki:benchmark'
+    devnull = open(os.devnull, 'w')
+
+    print('%10s %8s %12s %12s %8s %12s' % ('body id', 'KiB', 'find_all x7', 'single walk', 'speedup', 'convert'))
+    totals = [0.0, 0.0]
+    for size, id, body in bodies:
+        soup = BeautifulSoup(body, 'html.parser')
+        legacy = best_of(args.repeat, lambda: legacy_traversals(soup))
+        walk = best_of(args.repeat, lambda: extract.collect_rewrites(soup))
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            whole = best_of(1, lambda: extract.convert(body, page))
+        finally:
+            sys.stdout = stdout
+        totals[0] += legacy
+        totals[1] += walk
+        print('%10s %8.1f %10.2fms %10.2fms %7.1fx %10.2fms' % (
+            id, size / 1024, legacy * 1000, walk * 1000, legacy / walk, whole * 1000))
+    if bodies:
+        print('%19s %10.2fms %10.2fms %7.1fx' % ('total', totals[0] * 1000, totals[1] * 1000,
+                                                totals[0] / totals[1]))
+
+if __name__ == '__main__':
+    main()
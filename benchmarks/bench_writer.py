@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# Benchmark writing exported pages: the old write_page(), which called
+# os.makedirs() and wrote every page twice (the second time to
+# most_recent_page.md), against OutputWriter, with and without its
+# writer thread. Point --dir at a network filesystem to see the
+# difference the saved metadata operations make there.
+#
+#   python3 benchmarks/bench_writer.py [--dir DIR] [--pages N] [--size BYTES]
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from corpus import extract
+
+def legacy_write_page(filename, markdown):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    f = open(filename, 'w', encoding="utf-8")
+    f.write(markdown)
+    f.close()
+    f = open("most_recent_page.md", 'w', encoding="utf-8")
+    f.write(markdown)
+    f.close()
+
+def page_files(pages, fanout):
+    # a tree of pages, fanout children per page
+    names = []
+    for i in range(pages):
+        parts = []
+        n = i
+        while n:
+            parts.append('page_%d' % (n % fanout))
+            n //= fanout
+        names.append(os.path.join('pages', 'current', *reversed(parts or ['page_0'])) + '.txt')
+    return names
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark page output')
+    parser.add_argument('--dir', help='where to write (default: a temporary directory)')
+    parser.add_argument('--pages', type=int, default=5000)
+    parser.add_argument('--size', type=int, default=4000, help='bytes per page')
+    parser.add_argument('--fanout', type=int, default=8, help='children per page')
+    args = parser.parse_args()
+
+    top = tempfile.mkdtemp(prefix='c2d-writer-', dir=args.dir)
+    files = page_files(args.pages, args.fanout)
+    markdown = ('x' * 79 + '\n') * (args.size // 80)
+    cwd = os.getcwd()
+    try:
+        for name in ('legacy', 'OutputWriter', 'OutputWriter, thread'):
+            out = os.path.join(top, name.replace(', ', '-'))
+            os.makedirs(out)
+            os.chdir(out)
+            start = time.perf_counter()
+            if name == 'legacy':
+                for f in files:
+                    legacy_write_page(f, markdown)
+            else:
+                writer = extract.OutputWriter(threaded=name.endswith('thread'))
+                for f in files:
+                    writer.write(f, markdown)
+                writer.close()
+            elapsed = time.perf_counter() - start
+            os.chdir(cwd)
+            print('%-22s %8.2fs %8.1fus/page' % (name, elapsed, elapsed / len(files) * 1e6))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(top)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+# Page bodies to benchmark with, from the export in the current
+# directory or from a BodyStore, and a small timing helper
+import heapq
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import extract
+
+# the n largest (size, BodyContent id, body) in the export
+def largest_bodies(n, body_store=None):
+    if body_store:
+        store = extract.BodyStore(body_store)
+        rows = store.db.execute('SELECT id, content FROM body ORDER BY length(content) DESC LIMIT ?', (n,))
+        return [(len(body), id, body) for id, body in rows]
+    largest = []
+    for obj in extract.iter_objects('entities.xml'):
+        if obj.get('class') != 'BodyContent':
+            continue
+        body = obj.find('property[@name="body"]').text or ''
+        item = (len(body), obj.find('id').text, body)
+        if len(largest) < n:
+            heapq.heappush(largest, item)
+        else:
+            heapq.heappushpop(largest, item)
+    return sorted(largest, reverse=True)
+
+def best_of(repeat, fn):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# Profile md() on a link-heavy page: the old way, with a new
+# ConfluenceConverter per page and the old convert_a's four re.sub()
+# calls with inline patterns per anchor, against the shared converter
+# and the host rewrites compiled once from mappings.urlRewrites. The
+# anchors convert faster; the page as a whole does not measurably,
+# since markdownify's own tree walk is nearly all of its time.
+#
+#   python3 benchmarks/profile_links.py [--links N] [--pages N] [--top N]
+import argparse
+import cProfile
+import pstats
+import re
+import time
+
+from corpus import extract
+
+# convert_a as it was, including its assignment to hext, which left
+# ssrg.nicta.com.au in the link text
+class LegacyConverter(extract.ConfluenceConverter):
+    def convert_a(self, el, text, convert_as_inline):
+        href = el.get('href')
+        href = re.sub(r'ts\.data61\.csiro\.au', 'trustworthy.systems', str(href))
+        text = re.sub(r'ts\.data61\.csiro\.au', 'trustworthy.systems', str(text))
+        href = re.sub(r'ssrg\.nicta\.com\.au', 'trustworthy.systems', href)
+        hext = re.sub(r'ssrg\.nicta\.com\.au', 'trustworthy.systems', text)
+
+        return '[[%s|%s]]' % ( href, text)
+
+def legacy_md(html):
+    return LegacyConverter().convert(html)
+
+def link_page(links):
+    hosts = ['ts.data61.csiro.au', 'ssrg.nicta.com.au', 'sel4.systems', 'example.org']
+    items = []
+    for i in range(links):
+        host = hosts[i % len(hosts)]
+        items.append('<li><a href="https://%s/page/%d">%s page %d</a></li>' % (host, i, host, i))
+    return '<h1>Links</h1><ul>%s</ul>' % ''.join(items)
+
+def run(fn, html, pages):
+    start = time.perf_counter()
+    for _ in range(pages):
+        fn(html)
+    return time.perf_counter() - start
+
+# what converting the anchors costs, apart from the rest of markdownify
+anchorCalls = r'convert_a|link_markup|rewrite_hosts|re/__init__|markdownify/__init__.py:\d+\((__init__|_todict)\)'
+
+def main():
+    parser = argparse.ArgumentParser(description='Profile md() on link-heavy pages')
+    parser.add_argument('--links', type=int, default=500, help='anchors per page')
+    parser.add_argument('--pages', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    html = link_page(args.links)
+    # the same markup, but for the link text the old code left alone
+    assert legacy_md(html).replace('ssrg.nicta.com.au', 'trustworthy.systems') == extract.md(html)
+    for name, fn in (('legacy', legacy_md), ('current', extract.md)):
+        profile = cProfile.Profile()
+        profile.enable()
+        run(fn, html, args.pages)
+        profile.disable()
+        print('==== %s: anchor conversion and converter set-up' % name)
+        pstats.Stats(profile).sort_stats('tottime').print_stats(anchorCalls)
+
+    soup = extract.BeautifulSoup(link_page(args.links), 'html.parser')
+    anchors = soup.find_all('a')
+    legacy_a = LegacyConverter().convert_a
+    best = dict(legacy=[], current=[])
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        for a in anchors:
+            legacy_a(a, a.get_text(), False)
+        best['legacy'].append(time.perf_counter() - start)
+        start = time.perf_counter()
+        for a in anchors:
+            extract.link_markup(a, a.get_text())
+        best['current'].append(time.perf_counter() - start)
+    print('convert_a alone, best of %d:' % args.repeat)
+    for name in ('legacy', 'current'):
+        print('  %-8s %6.2fus/anchor' % (name, min(best[name]) / len(anchors) * 1e6))
+
+    # taken in turn, so that changes in the machine's load fall on both
+    times = dict(legacy=[], current=[])
+    for _ in range(args.repeat):
+        for name, fn in (('legacy', legacy_md), ('current', extract.md)):
+            times[name].append(run(fn, html, args.pages) / args.pages * 1000)
+    print('md() on %d pages of %d links, %d runs each:' % (args.pages, args.links, args.repeat))
+    for name in ('legacy', 'current'):
+        t = sorted(times[name])
+        print('  %-8s best %6.2fms/page, median %6.2fms/page' % (name, t[0], t[len(t) // 2]))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# Benchmark extract.py on synthetic exports of several sizes, so that
+# timings can be reproduced without a real export. For each size this
+# generates an export with synthetic_export.py, then:
+#  - runs extract.py on it as a whole, and reads the stage timings from
+#    its run report;
+#  - times convert(), md() and build_path() on their own, over every
+#    page of the export, and scan_attachments() and
+#    materialize_attachments() (which scans them too) placing every
+#    attachment of its pages.
+#
+#   python3 benchmarks/run_benchmarks.py [--pages 100,1000,5000] [--json FILE] [-- extract.py options]
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import synthetic_export
+
+here = os.path.dirname(os.path.abspath(__file__))
+extract_py = os.path.join(here, '..', 'extract.py')
+
+# Time the parts of extract.py in the export in the current directory.
+# Run in its own process, so each export starts from fresh module state.
+def measure_stages():
+    import corpus
+    extract = corpus.extract
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        extract.load_tree('entities.xml')
+        extract.build_hierarchy()
+        pages = [p for p, depth in extract.hierarchy.walk()
+                 if p.bodyId != '0' and p.is_latest()]
+
+        # build_path() memoizes, so time it on a fresh hierarchy
+        extract.hierarchy = extract.Hierarchy()
+        start = time.perf_counter()
+        for p in extract.pageNames.values():
+            extract.build_path(p)
+        build_path = time.perf_counter() - start
+        paths = len(extract.pageNames)
+
+        attachments = [a for p in pages for a in p.attaches]
+        start = time.perf_counter()
+        extract.scan_attachments()
+        scan = time.perf_counter() - start
+        # placed as a data directory of their own, so as not to touch the export
+        media = dict((a.filename, (a.page.id, a.id)) for a in attachments)
+        with tempfile.TemporaryDirectory() as data:
+            extract.dataDir = data
+            start = time.perf_counter()
+            extract.materialize_attachments(media, extract.OutputWriter())
+            materialize = time.perf_counter() - start
+            extract.dataDir = None
+
+        converted = []
+        start = time.perf_counter()
+        for p in pages:
+            converted.append(extract.convert(extract.PageContent[p.bodyId], p))
+        convert = time.perf_counter() - start
+        start = time.perf_counter()
+        for html in converted:
+            extract.md(html)
+        md = time.perf_counter() - start
+    finally:
+        sys.stdout = stdout
+    return {
+        'exported_pages': len(pages),
+        'convert_ms_per_page': convert / max(len(pages), 1) * 1000,
+        'md_ms_per_page': md / max(len(pages), 1) * 1000,
+        'build_path_us_per_page': build_path / max(paths, 1) * 1e6,
+        'scan_attachments_ms': scan * 1000,
+        'materialize_attachments_us_per_file': materialize / max(len(media), 1) * 1e6,
+    }
+
+def run_pipeline(directory, extract_args):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, extract_py, '--no-ldap', '--report', 'report.json'] + extract_args,
+                   cwd=directory, stdout=subprocess.DEVNULL, check=True)
+    wall = time.perf_counter() - start
+    with open(os.path.join(directory, 'report.json')) as f:
+        report = json.load(f)
+    return {
+        'wall_seconds': wall,
+        'peak_rss_mib': report['peak_rss_mib'],
+        'stages': dict((s['stage'], s['wall_seconds']) for s in report['stages']),
+    }
+
+def main():
+    if sys.argv[1:2] == ['--measure-stages']:
+        json.dump(measure_stages(), sys.stdout)
+        return
+
+    parser = argparse.ArgumentParser(description='Benchmark extract.py on synthetic exports')
+    parser.add_argument('--pages', default='100,1000', help='comma-separated export sizes, in pages')
+    parser.add_argument('--history', type=int, default=2)
+    parser.add_argument('--attachments', type=int, default=2)
+    parser.add_argument('--body-size', type=int, default=2000)
+    parser.add_argument('--macro-rate', type=float, default=0.8)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', metavar='FILE', help='also write the results here')
+    parser.add_argument('--keep', metavar='DIR', help='generate the exports under DIR and keep them')
+    parser.add_argument('extract_args', nargs='*', help='options for extract.py, after --')
+    args = parser.parse_args()
+
+    top = args.keep or tempfile.mkdtemp(prefix='c2d-bench-')
+    results = []
+    try:
+        for pages in [int(n) for n in args.pages.split(',')]:
+            directory = os.path.join(top, 'export-%d' % pages)
+            gen_args = synthetic_export.make_parser().parse_args([
+                directory, '--pages', str(pages), '--history', str(args.history),
+                '--attachments', str(args.attachments), '--body-size', str(args.body_size),
+                '--macro-rate', str(args.macro_rate), '--seed', str(args.seed)])
+            start = time.perf_counter()
+            synthetic_export.generate(gen_args)
+            print('%d pages: generated in %.1fs' % (pages, time.perf_counter() - start))
+
+            pipeline = run_pipeline(directory, args.extract_args)
+            stages = subprocess.run([sys.executable, os.path.abspath(__file__), '--measure-stages'],
+                                    cwd=directory, stdout=subprocess.PIPE, check=True)
+            result = dict(pages=pages, pipeline=pipeline, **json.loads(stages.stdout))
+            results.append(result)
+
+            print('  pipeline %.2fs, peak %.1f MiB: %s' % (
+                pipeline['wall_seconds'], pipeline['peak_rss_mib'],
+                ', '.join('%s %.2fs' % s for s in pipeline['stages'].items())))
+            print('  convert %.2fms/page, md %.2fms/page, build_path %.2fus/page, '
+                  'scan_attachments %.2fms, materialize_attachments %.2fus/file' % (
+                      result['convert_ms_per_page'], result['md_ms_per_page'],
+                      result['build_path_us_per_page'], result['scan_attachments_ms'],
+                      result['materialize_attachments_us_per_file']))
+            if not args.keep:
+                shutil.rmtree(directory)
+    finally:
+        if not args.keep:
+            shutil.rmtree(top, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# Generate a synthetic Confluence space export, entities.xml and an
+# attachments/ tree, made of the objects extract.py reads: users,
+# pages with historical versions, attachments with several file
+# versions, page bodies with links, images, user mentions, tables,
+# lists, tasks, emoticons and macros, and blog posts. Sizes are
+# tunable, and the same seed gives the same export.
+#
+#   python3 benchmarks/synthetic_export.py OUTPUT_DIR [--pages N] [--history N] ...
+import argparse
+import os
+import random
+from xml.sax.saxutils import escape
+
+PKG = 'com.atlassian.confluence.pages'
+
+def cdata(s):
+    return '<![CDATA[%s]]>' % s.replace(']]>', ']]]]><![CDATA[>')
+
+def prop(name, value):
+    return '<property name="%s">%s</property>' % (name, cdata(str(value)))
+
+def ref(name, cls, id, idname='id'):
+    return '<property name="%s" class="%s" package="%s"><id name="%s">%s</id></property>' % (
+        name, cls, PKG, idname, id)
+
+def collection(name, cls, ids):
+    if not ids:
+        return ''
+    els = ''.join('<element class="%s" package="%s"><id name="id">%s</id></element>' % (cls, PKG, i)
+                  for i in ids)
+    return '<collection name="%s" class="java.util.Collection">%s</collection>' % (name, els)
+
+WORDS = ('kernel proof seL4 capability microkernel verification isabelle memory '
+         'thread scheduler interrupt device driver benchmark cache page table '
+         'the of and to in is for with on that').split()
+
+def words(rng, n):
+    return ' '.join(rng.choice(WORDS) for _ in range(n))
+
+RICH = [
+    # nested macros
+    '<ac:structured-macro ac:name="panel"><ac:parameter ac:name="title">Outer</ac:parameter>'
+    '<ac:rich-text-body><p>before</p><ac:structured-macro ac:name="code"><ac:plain-text-body>'
+    '<![CDATA[x = 1]]></ac:plain-text-body></ac:structured-macro><p>after</p></ac:rich-text-body>'
+    '</ac:structured-macro>',
+    '<ac:structured-macro ac:name="expand"><ac:rich-text-body><ac:structured-macro ac:name="info">'
+    '<ac:rich-text-body><p>inner info</p></ac:rich-text-body></ac:structured-macro></ac:rich-text-body>'
+    '</ac:structured-macro>',
+    # an unhandled macro around a handled one
+    '<ac:structured-macro ac:name="jira"><ac:parameter ac:name="key">SEL4-1</ac:parameter>'
+    '<ac:rich-text-body><ac:structured-macro ac:name="note"><ac:rich-text-body><p>n</p>'
+    '</ac:rich-text-body></ac:structured-macro></ac:rich-text-body></ac:structured-macro>',
+    '<ac:structured-macro ac:name="section"><ac:rich-text-body><ac:structured-macro ac:name="column">'
+    '<ac:parameter ac:name="width">50%</ac:parameter><ac:rich-text-body><p>left</p></ac:rich-text-body>'
+    '</ac:structured-macro></ac:rich-text-body></ac:structured-macro>',
+    '<ac:structured-macro ac:name="toc" />',
+    '<ac:structured-macro ac:name="status"><ac:parameter ac:name="title">DONE</ac:parameter></ac:structured-macro>',
+    # tasks and emoticons
+    '<ac:task-list><ac:task><ac:task-id>1</ac:task-id><ac:task-status>complete</ac:task-status>'
+    '<ac:task-body>ship it</ac:task-body></ac:task><ac:task><ac:task-id>2</ac:task-id>'
+    '<ac:task-status>incomplete</ac:task-status><ac:task-body>test it</ac:task-body></ac:task></ac:task-list>',
+    '<p>happy <img class="emoticon emoticon-smile" title="(smile)" src="x.png" /> and '
+    '<img class="emoticon" title=":wave:" src="y.png" /></p>',
+    '<p><a href="https://ts.data61.csiro.au/projects/">old site</a> and '
+    '<a href="http://ssrg.nicta.com.au/x">ssrg.nicta.com.au</a></p>',
+    '<h2>Heading</h2><blockquote><p>quoted <em>text</em></p></blockquote><hr />'
+    '<ol><li>one<ul><li>nested</li></ul></li><li>two</li></ol><pre>pre  formatted</pre>',
+]
+
+def make_body(rng, args, page, titles, attach_names, userkeys):
+    parts = []
+    size = 0
+    while size < args.body_size:
+        kind = rng.randrange(10)
+        if kind < 3:
+            s = '<p>%s <strong>%s</strong> %s</p>' % (words(rng, 12), words(rng, 2), words(rng, 8))
+        elif kind == 4 and titles:
+            s = '<p>See <ac:link><ri:page ri:content-title="%s" /></ac:link>.</p>' % escape(
+                rng.choice(titles), {'"': '&quot;'})
+        elif kind == 5 and attach_names:
+            name = rng.choice(attach_names)
+            if name.endswith('.png'):
+                s = '<p><ac:image><ri:attachment ri:filename="%s" /></ac:image></p>' % name
+            else:
+                s = '<p><ac:link><ri:attachment ri:filename="%s" /></ac:link></p>' % name
+        elif kind == 6 and userkeys:
+            s = '<p>Ask <ac:link><ri:user ri:userkey="%s" /></ac:link></p>' % rng.choice(userkeys)
+        elif kind == 3 and rng.random() < args.macro_rate:
+            m = rng.choice(['code', 'info', 'panel', 'note', 'expand'])
+            if m == 'code':
+                s = ('<ac:structured-macro ac:name="code"><ac:parameter ac:name="language">c'
+                     '</ac:parameter><ac:plain-text-body>%s</ac:plain-text-body>'
+                     '</ac:structured-macro>' % cdata('int main(void) { return 0; }'))
+            else:
+                s = ('<ac:structured-macro ac:name="%s"><ac:parameter ac:name="title">%s'
+                     '</ac:parameter><ac:rich-text-body><p>%s</p></ac:rich-text-body>'
+                     '</ac:structured-macro>' % (m, words(rng, 2), words(rng, 10)))
+        elif kind == 7 and rng.random() < args.macro_rate:
+            s = rng.choice(RICH)
+        elif kind == 8:
+            rows = ''.join('<tr><td>%s</td><td>%s</td></tr>' % (words(rng, 2), words(rng, 3))
+                           for _ in range(4))
+            s = '<table><tbody><tr><th>A</th><th>B</th></tr>%s</tbody></table>' % rows
+        else:
+            s = '<ul><li>%s</li><li>%s <ac:emoticon ac:name="smile" /></li></ul>' % (
+                words(rng, 5), words(rng, 5))
+        parts.append(s)
+        size += len(s)
+    return ''.join(parts)
+
+def generate(args):
+    rng = random.Random(args.seed)
+    os.makedirs(args.output, exist_ok=True)
+    next_id = [1000]
+
+    def new_id():
+        next_id[0] += 1
+        return next_id[0]
+
+    userkeys = ['ff80818100000000%04d' % i for i in range(args.users)]
+    out = open(os.path.join(args.output, 'entities.xml'), 'w', encoding='utf-8')
+    out.write('<?xml version="1.0" encoding="UTF-8"?>\n<hibernate-generic datetime="2020-01-01 00:00:00">\n')
+
+    for i, key in enumerate(userkeys):
+        out.write('<object class="ConfluenceUserImpl" package="com.atlassian.confluence.user">'
+                  '<id name="key">%s</id>%s%s</object>\n' % (
+                      cdata(key), prop('name', 'user%d' % i),
+                      prop('email', 'first%d.last%d@example.com' % (i, i))))
+
+    titles = ['Page %d %s' % (i, rng.choice(WORDS)) for i in range(args.pages)]
+    page_ids = [new_id() for _ in range(args.pages)]
+    parents = []
+    depth = {}
+    for i, pid in enumerate(page_ids):
+        candidates = [page_ids[j] for j in range(i) if depth[page_ids[j]] < args.tree_depth]
+        if i == 0 or not candidates:
+            parents.append(None)
+            depth[pid] = 1
+        else:
+            parent = rng.choice(candidates[-50:])
+            parents.append(parent)
+            depth[pid] = depth[parent] + 1
+
+    for i, pid in enumerate(page_ids):
+        title = titles[i]
+        attach_ids = []
+        attach_names = []
+        for a in range(args.attachments):
+            aid = new_id()
+            ext = rng.choice(['.png', '.pdf', '.txt'])
+            name = 'file_%d_%d%s' % (i, a, ext)
+            attach_ids.append(aid)
+            attach_names.append(name)
+            out.write('<object class="Attachment" package="%s"><id name="id">%d</id>%s%s%s</object>\n' % (
+                PKG, aid, prop('title', name), prop('version', 1),
+                ref('containerContent', 'Page', pid)))
+            adir = os.path.join(args.output, 'attachments', str(pid), str(aid))
+            os.makedirs(adir, exist_ok=True)
+            for v in range(1, rng.randint(1, 3) + 1):
+                with open(os.path.join(adir, str(v)), 'wb') as f:
+                    f.write(('%s version %d\n' % (name, v)).encode() * 16)
+
+        versions = [(new_id(), v + 1) for v in range(args.history)]
+        latest_version = args.history + 1
+        for body_owner, version in versions + [(pid, latest_version)]:
+            body_id = new_id()
+            body = make_body(rng, args, pid, titles, attach_names, userkeys)
+            out.write('<object class="BodyContent" package="com.atlassian.confluence.core">'
+                      '<id name="id">%d</id>%s%s</object>\n' % (
+                          body_id, prop('body', body), ref('content', 'Page', body_owner)))
+            xml = ['<object class="Page" package="%s"><id name="id">%d</id>' % (PKG, body_owner),
+                   prop('title', title), prop('version', version),
+                   prop('contentStatus', 'current'),
+                   prop('lastModificationDate', '2019-%02d-%02d 10:00:00.000' % (
+                       (version % 12) + 1, (i % 28) + 1)),
+                   ref('lastModifier', 'ConfluenceUserImpl', rng.choice(userkeys) if userkeys else '', 'key'),
+                   collection('bodyContents', 'BodyContent', [body_id])]
+            if parents[i] is not None:
+                xml.append(ref('parent', 'Page', parents[i]))
+            if body_owner == pid:
+                xml.append(collection('attachments', 'Attachment', attach_ids))
+                xml.append(collection('historicalVersions', 'Page', [v[0] for v in versions]))
+            else:
+                xml.append(ref('originalVersion', 'Page', pid))
+            xml.append('</object>\n')
+            out.write(''.join(xml))
+
+    for b in range(args.blogs):
+        bid = new_id()
+        body_id = new_id()
+        out.write('<object class="BodyContent" package="com.atlassian.confluence.core">'
+                  '<id name="id">%d</id>%s</object>\n' % (
+                      body_id, prop('body', make_body(rng, args, bid, titles, [], userkeys))))
+        out.write('<object class="BlogPost" package="%s"><id name="id">%d</id>%s%s%s%s</object>\n' % (
+            PKG, bid, prop('title', 'Blog %d' % b), prop('version', 1),
+            prop('contentStatus', 'current'), collection('bodyContents', 'BodyContent', [body_id])))
+
+    out.write('</hibernate-generic>\n')
+    out.close()
+
+def make_parser():
+    parser = argparse.ArgumentParser(description='Generate a synthetic Confluence export')
+    parser.add_argument('output', help='directory to write entities.xml and attachments/ to')
+    parser.add_argument('--pages', type=int, default=100)
+    parser.add_argument('--history', type=int, default=2, help='historical versions per page')
+    parser.add_argument('--tree-depth', type=int, default=5, help='deepest level of the page tree')
+    parser.add_argument('--attachments', type=int, default=2, help='attachments per page')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--blogs', type=int, default=3, help='blog posts')
+    parser.add_argument('--macro-rate', type=float, default=0.8,
+                        help='chance that a body part chosen to be a macro is one')
+    parser.add_argument('--body-size', type=int, default=2000, help='characters per page body')
+    parser.add_argument('--seed', type=int, default=1)
+    return parser
+
+def main():
+    generate(make_parser().parse_args())
+
+if __name__ == '__main__':
+    main()
@@ -2,66 +2,110 @@
 import sys
 import os
 import re
+import argparse
+import tempfile
+import time
+import sqlite3
+import errno
+import fcntl
+import shutil
+import json
+import hashlib
+import multiprocessing
+import threading
+import queue
+import tarfile
+import subprocess
+import io
+import pickle
+import traceback
+import zipfile
+import csv
+import html
+import html.entities
+import heapq
+import resource
+import gzip
+import calendar
+import importlib
+import importlib.util
+import importlib.metadata
+import functools
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from mappings import userMapping
+try:
+    from mappings import urlRewrites
+except ImportError:
+    # a mappings.py from before the table was added
+    urlRewrites = {
+        'ts.data61.csiro.au': 'trustworthy.systems',
+        'ssrg.nicta.com.au': 'trustworthy.systems',
+    }
 import xml.etree.ElementTree as ET
 from markdownify import MarkdownConverter
-from bs4 import BeautifulSoup
-# For user names
-import ldap
-
-ldapserver = 'ldap://ldap.keg.cse.unsw.edu.au'
-base = 'ou=Accounts,dc=keg,dc=cse,dc=unsw,dc=edu,dc=au'
-searchAttributes=['cn', 'uid']
-
-ld = ldap.initialize(ldapserver)
-ld.protocol_version = ldap.VERSION3
-searchFilter=[]
-for x in userMapping:
-    searchFilter.append('(uid=' + userMapping[x] + ')')
-searchFilter = '(|' + ''.join(searchFilter) + ')'
-
-# Build dictionary of uid->name from our ldap database
-LDAPusers = ld.search(base, ldap.SCOPE_SUBTREE, searchFilter, searchAttributes)
-LDAPuserName = {}
-while True:
-    result_type, result_data = ld.result(LDAPusers, 0)
-    if result_data == []:
-        break
-    if result_type == ldap.RES_SEARCH_ENTRY:
-        results = result_data[0][1]
-        if 'uid' in results:
-            uid = results['uid'][0].decode('utf-8')
-            name = results['cn'][0].decode('utf-8')
-            LDAPuserName[uid] = name
+from bs4 import BeautifulSoup, Tag, NavigableString, Comment, Doctype
+# For user names; only needed to look names up in LDAP
+try:
+    import ldap
+    import ldap.filter
+except ImportError:
+    ldap = None
+# Only needed for --tar FILE.tar.zst, which can also use the zstd command
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 class ConfluenceConverter(MarkdownConverter):
     """
     Pass through some macros
     """
     def convert_panel(self, el, text, convert_as_inline):
-        title =  el.get('title')
-        if title:
-            title = 'title="%s"' % title
-        else:
-            title = ''
-        tt = el.get('type')
-        if tt:
-            tt = 'type="%s" ' % tt
-        else:
-            tt = ''
-        return "<panel %s %s>%s</panel>" % (title, tt, text)
+        return panel_markup(el, text)
 
     def convert_a(self, el, text, convert_as_inline):
-        href = el.get('href')
-        href = re.sub(r'ts\.data61\.csiro\.au', 'trustworthy.systems', str(href))
-        text = re.sub(r'ts\.data61\.csiro\.au', 'trustworthy.systems', str(text))
-        href = re.sub(r'ssrg\.nicta\.com\.au', 'trustworthy.systems', href)
-        hext = re.sub(r'ssrg\.nicta\.com\.au', 'trustworthy.systems', text)
+        return link_markup(el, text)
+
+# shared with the native renderer
+def panel_markup(el, text):
+    title =  el.get('title')
+    if title:
+        title = 'title="%s"' % title
+    else:
+        title = ''
+    tt = el.get('type')
+    if tt:
+        tt = 'type="%s" ' % tt
+    else:
+        tt = ''
+    return "<panel %s %s>%s</panel>" % (title, tt, text)
+
+# One pattern matching every host in urlRewrites, longest first
+if urlRewrites:
+    urlHosts = re.compile('|'.join(re.escape(host) for host in
+                                   sorted(urlRewrites, key=len, reverse=True)))
+else:
+    urlHosts = None
+
+def rewrite_hosts(s):
+    if urlHosts is None:
+        return s
+    return urlHosts.sub(lambda m: urlRewrites[m.group(0)], s)
+
+def link_markup(el, text):
+    href = rewrite_hosts(str(el.get('href')))
+    text = rewrite_hosts(str(text))
+    return '[[%s|%s]]' % ( href, text)
 
-        return '[[%s|%s]]' % ( href, text)
+# converting a page keeps no state in the converter, so pages share one
+defaultConverter = ConfluenceConverter()
 
 def md(html, **options):
-    return ConfluenceConverter(**options).convert(html)
+    if options:
+        return ConfluenceConverter(**options).convert(html)
+    return defaultConverter.convert(html)
 
 
 # WHAT THIS DOES
@@ -86,9 +130,12 @@ def md(html, **options):
 hiversions={}
 users={}
 attachments = {}
-attachmentIndex = {}
 pageNames = {}
-outDated = []
+# ids of all historical (not latest) page versions
+outDated = set()
+pages = {}
+# BodyContent id -> body; a BodyStore when streaming or with --body-store
+PageContent = {}
 
 emoticons_symbols = {
     "smile" : ":-)",
@@ -112,20 +159,141 @@ emoticons_symbols = {
     
 }
 
+# ------------ user names ------------
+
+# A resolver looks up display names for local user ids:
+# lookup(uids) returns {uid: name} for the uids it knows about.
+
+class LdapResolver:
+    def __init__(self, server, base, batch=50, threads=4):
+        self.server = server
+        self.base = base
+        self.batch = batch
+        self.threads = threads
+
+    def search(self, uids):
+        ld = ldap.initialize(self.server)
+        ld.protocol_version = ldap.VERSION3
+        searchFilter = '(|' + ''.join('(uid=%s)' % ldap.filter.escape_filter_chars(u) for u in uids) + ')'
+        msgid = ld.search(self.base, ldap.SCOPE_SUBTREE, searchFilter, ['cn', 'uid'])
+        names = {}
+        while True:
+            result_type, result_data = ld.result(msgid, 0)
+            if result_data == []:
+                break
+            if result_type == ldap.RES_SEARCH_ENTRY:
+                results = result_data[0][1]
+                if 'uid' in results:
+                    uid = results['uid'][0].decode('utf-8')
+                    name = results['cn'][0].decode('utf-8')
+                    names[uid] = name
+        ld.unbind_s()
+        return names
+
+    # search in batches, several at once
+    def lookup(self, uids):
+        batches = [uids[i:i + self.batch] for i in range(0, len(uids), self.batch)]
+        names = {}
+        with ThreadPoolExecutor(self.threads) as pool:
+            for found in pool.map(self.search, batches):
+                names.update(found)
+        return names
+
+class FileResolver:
+    """
+    Names from a JSON object of {uid: name}, or a CSV file of uid,name lines
+    """
+    def __init__(self, filename):
+        self.filename = filename
+
+    def lookup(self, uids):
+        with open(self.filename, encoding='utf-8', newline='') as f:
+            if self.filename.endswith('.json'):
+                names = json.load(f)
+            else:
+                names = dict(row[:2] for row in csv.reader(f) if len(row) >= 2)
+        return dict((u, names[u]) for u in uids if u in names)
+
+class NameCache:
+    """
+    uid -> display name, kept on disk between runs. Entries older
+    than the TTL (in seconds) are looked up again, but are still used
+    if that lookup cannot be done. A name of None means 'not found'.
+    """
+    def __init__(self, filename=None, ttl=0):
+        self.filename = filename
+        self.ttl = ttl
+        # uid -> [name, time looked up]
+        self.entries = {}
+        if filename:
+            try:
+                with open(filename, encoding='utf-8') as f:
+                    self.entries = json.load(f)
+            except FileNotFoundError:
+                pass
+
+    def get(self, uid):
+        if uid in self.entries:
+            return self.entries[uid][0]
+        return None
+
+    def stale(self, uids):
+        now = time.time()
+        return [u for u in uids if u not in self.entries or now - self.entries[u][1] > self.ttl]
+
+    def update(self, uids, names):
+        now = time.time()
+        for u in uids:
+            self.entries[u] = [names.get(u), now]
+
+    def save(self):
+        if not self.filename:
+            return
+        with open(self.filename + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f)
+        os.replace(self.filename + '.tmp', self.filename)
+
+userNames = NameCache()
+
+# Refresh the cached names of uids in the background, so it overlaps
+# with loading entities.xml; join the returned thread before use
+def start_name_lookup(resolver, uids):
+    def run():
+        todo = userNames.stale(uids)
+        if not todo:
+            return
+        try:
+            names = resolver.lookup(todo)
+        except Exception as e:
+            print('User name lookup failed, using cached names: %s' % e)
+            return
+        userNames.update(todo, names)
+        userNames.save()
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+# pick up names that arrived after their user was loaded
+def apply_user_names():
+    for user in users.values():
+        name = userNames.get(user.userid)
+        if name:
+            user.name = name
+
 def localname(csiro_id):
     if csiro_id in userMapping:
         return userMapping[csiro_id]
     return csiro_id
 
-# Eventually add in an ldap lookup to convert to local user 
 class ConfluenceUser:
     def __init__(self, id, email, first, last, userid):
         self.id = id
         self.email = email
         self.name = first + ' ' + last
         login = localname(userid)
-        if login in LDAPuserName:
-            self.name = LDAPuserName[login]
+        name = userNames.get(login)
+        if name:
+            self.name = name
         self.userid = login or first + '_' + last
         users[id] = self
 
@@ -144,6 +312,11 @@ class Page:
         self.bodyId = bodyid
         self.status = status
         self.attaches = attaches
+        self.is_blog = False
+        # when this version was made, by whom (a user key), and why
+        self.modified = None
+        self.modifier = None
+        self.comment = ''
         pages[id] = self
         self.history = []
         if title:
@@ -152,8 +325,10 @@ class Page:
             self.filename = '__unknown__'
         self.fullpath = self.filename
         self.path = self.filename.replace('/', ':')
-        self.namespace = ':oldwiki'
+        self.namespace = ':' + wikiNamespace
         self.children = []
+        # attachment title -> Attachment, filled in by resolve_attachments()
+        self.attachByName = {}
         if title not in hiversions or hiversions[title] < self.version:
             hiversions[title] = self.version
             pageNames[title] = self
@@ -171,7 +346,6 @@ class Attachment:
         self.page = None        
         self.filename = ''
         attachments[id] = self
-        attachmentIndex[title] = self
 
     def __str__(self):
         return 'Attachment %s: "%s"' % (self.id, self.title)
@@ -182,35 +356,57 @@ def get_user(userkey):
     return None
 
 def find_attachment_in_page(link_name, page):
-    for a in page.attaches:
-        if (a.title == link_name):
-            return a.id
+    if link_name in page.attachByName:
+        return page.attachByName[link_name].id
     return '0'
 
 def sanitise_link_name(linkname):
     return linkname.replace(":", "")
 
+class PageState:
+    """
+    What rewriting a page finds out besides its markup: the attachment
+    files and pages it refers to, the macros it has, and what to warn
+    about it
+    """
+    def __init__(self):
+        # (page id, attachment id, media filename) for each attachment
+        # file; materialize_attachments() makes them
+        self.media = []
+        # titles of the pages linked to
+        self.linked_titles = []
+        # macro name -> how many the page has, handled or not
+        self.macros = {}
+        self.unhandled_macros = {}
+        # macro name -> seconds spent in its handler
+        self.macro_times = {}
+        # printed once the page is converted
+        self.warnings = []
+
+# of the page being converted
+pageState = PageState()
+
+# Something to tell about the page being converted. Rewrites and macro
+# handlers warn rather than print, so what they say goes with the page.
+def warn(message):
+    pageState.warnings.append(message)
+
 def rename_attachment_file(attach_id, safe_filename, page):
-    dir = 'attachments/%s/%s' % (page.id, attach_id)
-    # get all files
-    try: files = [f for f in os.listdir(dir)]
-    except FileNotFoundError: return
-    # get all files that can be parsed as an int
-    max_filenum = 0
-    for f in files:
-        # if the file already exists, skip this process
-        if (f == safe_filename): return
-        try:
-            f_num = int(f)
-            if f_num > max_filenum:
-                max_filenum = f_num
-        except: pass
-    orig_filepath = os.path.join(dir, str(max_filenum))
-    os.makedirs(os.path.dirname(safe_filename), exist_ok=True)
-    try:
-        os.link(orig_filepath, safe_filename)
-    except:
-        pass
+    pageState.media.append((page.id, attach_id, safe_filename))
+
+# id(tag) -> (tag, content key, names of the macros rewritten in it) for
+# each macro's result on the page being converted that the fragment cache
+# may render
+pageFragments = {}
+# id(tag) -> (placeholder tag, content key, Page) for each macro on the
+# page being converted that the fragment cache already has
+pagePlaceholders = {}
+# what the fragment cache marks and replaces macros with
+fragmentKey = 'c2d-key'
+fragmentTag = 'c2d-fragment'
+# tags whose markup depends on their siblings or parent, so are never
+# rendered from the fragment cache
+contextTags = set(['li', 'ul', 'ol', 'list', 'tr', 'td', 'th', 'code', 'kbd', 'samp'])
 
 # TODO: the files are actually just called 1/2/3 etc (no extension)
 # these names seem to be version names, so I think we should rename/copy the highest numbered file
@@ -218,7 +414,7 @@ def rename_attachment_file(attach_id, safe_filename, page):
 def make_attachment_link(link_name, soup, page):
     attach_id = find_attachment_in_page(link_name, page)
     if attach_id == '0':
-        print("Can't find attachment %s" % link_name)
+        warn("Can't find attachment %s" % link_name)
         return link_name
     attachment = attachments[attach_id]
     if attachment.filename == '':
@@ -231,7 +427,7 @@ def make_attachment_link(link_name, soup, page):
 def make_attachment_image(link_name, soup, page):
     attach_id = find_attachment_in_page(link_name, page)
     if attach_id == '0':
-        print("Can't find image %s" % link_name)
+        warn("Can't find image %s" % link_name)
         return 'IMAGE:  ' + link_name
     attachment = attachments[attach_id]
     rename_attachment_file(attach_id, attachment.filename, page)
@@ -249,6 +445,48 @@ def make_internal_link_p(page, soup):
     tag = '[[%s|%s]]' % (page.path, page.title)
     return tag
 
+# BeautifulSoup tree builder for page bodies:
+# 'html.parser', 'lxml' or 'lxml-xml'
+soupParser = 'html.parser'
+
+# for the small soups that macros and indexes build their output in
+def new_soup():
+    return BeautifulSoup('', 'html.parser')
+
+# Storage format uses ac: and ri: prefixes without declaring them, and
+# HTML entities that XML doesn't know about
+storageNamespaces = 'xmlns:ac="http://atlassian.com/content" xmlns:ri="http://atlassian.com/resource/identifier"'
+namedEntity = re.compile(r'&([A-Za-z][A-Za-z0-9]*);')
+cdataSection = re.compile(r'<!\[CDATA\[(.*?)\]\]>', re.S)
+
+def numeric_entity(m):
+    name = m.group(1)
+    if name in ('amp', 'lt', 'gt', 'quot', 'apos') or name not in html.entities.name2codepoint:
+        return m.group(0)
+    return '&#%d;' % html.entities.name2codepoint[name]
+
+def parse_storage(confluence):
+    if soupParser == 'lxml-xml':
+        body = namedEntity.sub(numeric_entity, confluence)
+        soup = BeautifulSoup('<confluence %s>%s</confluence>' % (storageNamespaces, body), 'lxml-xml')
+        soup.find('confluence').unwrap()
+        # the rest of the script looks tags up as 'ac:link' etc.
+        for tag in soup.find_all(True):
+            if tag.prefix and not tag.name.startswith(tag.prefix + ':'):
+                tag.name = tag.prefix + ':' + tag.name
+                tag.prefix = None
+        return soup
+    if soupParser == 'lxml':
+        # lxml's HTML parser turns CDATA sections into comments
+        body = cdataSection.sub(lambda m: html.escape(m.group(1), quote=False), confluence)
+        soup = BeautifulSoup(body, 'lxml')
+        for wrapper in ('html', 'body'):
+            tag = soup.find(wrapper)
+            if tag:
+                tag.unwrap()
+        return soup
+    return BeautifulSoup(confluence, soupParser)
+
 def make_toc(page: Page, soup):
     hh = soup.new_tag("h2")
     hh.string = "Pages below this page:"
@@ -262,15 +500,15 @@ def make_toc(page: Page, soup):
     return soup
 
 def make_toc_page(page: Page):
-    soup = BeautifulSoup('');
+    soup = new_soup()
     title = soup.new_tag("h1")
     title.string = page.title
     soup.insert(0, title)
     make_toc(page, soup)
-    return str(soup)
+    return soup
 
 def make_attachment_index(page: Page, unref_attachments):
-    soup = BeautifulSoup('')
+    soup = new_soup()
     if len(unref_attachments) == 0:
         return soup
     title = soup.new_tag('h2')
@@ -304,16 +542,16 @@ def code_macro(soup, page):
     lang = soup.find_all(attrs = {"ac:name", "language"})
     body = soup.find('ac:plain-text-body')
     if body is None:
-        print('Page %s: macro has no plain-text-body' % page.title)
-        print('"""' + '\n'.join(soup.contents) + '"""')
+        warn('Page %s: macro has no plain-text-body' % page.title)
+        warn('"""' + '\n'.join(soup.contents) + '"""')
         return soup
     content = body.contents
-    soup = BeautifulSoup('')
+    soup = new_soup()
     pre = soup.new_tag('pre')
     code = soup.new_tag('code')
     if lang:
         code['language'] = lang.string
-    code.contents = content
+    code.extend(list(content))
     pre.append(code)
     return pre
 
@@ -329,14 +567,14 @@ def status_macro(soup, page):
     colour = soup.find_all(attrs={'ac:name', 'colour'})
     if colour:
         colourStyle = 'padding:2px; background-color:' + colour.string + ';'
-        print('Colour styling %s' % colourStyle)
+        warn('Colour styling %s' % colourStyle)
         colour.replace_with('')
     else:
         colourStyle = ''
     content = soup.get_text()
     if content is None:
         return ''
-    soup = BeautifulSoup('')
+    soup = new_soup()
     span = soup.new_tag('span')
     span.attrs['style'] = '%s font-size:130%%; border=2px;' % colourStyle
     span.string = content
@@ -345,12 +583,12 @@ def status_macro(soup, page):
     
 def box_macro(soup, page, boxtype, title = None):
     content = soup.find('ac:rich-text-body').contents
-    soup = BeautifulSoup('')
+    soup = new_soup()
     panel = soup.new_tag('panel')
     panel['type'] = boxtype
     if title:
         panel['title'] = title
-    panel.contents = content
+    panel.extend(list(content))
     soup.append(panel)
     return soup
 
@@ -372,20 +610,20 @@ def note_macro(soup, page):
 def panel_macro(soup, page):
     title = soup.find('ac:parameter', attrs={'ac:name', 'title'})
     body = soup.find('ac:rich-text-body').contents
-    soup = BeautifulSoup('')
+    soup = new_soup()
     panel = soup.new_tag('panel')
     if title:
         panel['title'] = title.string
-    panel.contents = body
+    panel.extend(list(body))
     soup.append(panel)
     return soup
 
 def column_macro(soup, page):
     width = soup.find_all(attrs = {'ac:name': 'width'})
     body = soup.find('ac:rich-text-body')
-    soup = BeautifulSoup('');
+    soup = new_soup()
     col = soup.new_tag('col')
-    col.contents = body.contents
+    col.extend(list(body.contents))
     if width:
         col['lg'] = str(int(width[0].string.strip('%')) * 12 /100)
     soup.append(col)
@@ -393,219 +631,838 @@ def column_macro(soup, page):
 
 def section_macro(soup, page):
     body = soup.find('ac:rich-text-body')
-    soup = BeautifulSoup('')
+    soup = new_soup()
     row = soup.new_tag('row')
-    row.contents = body.contents
+    row.extend(list(body.contents))
     soup.append(row)
     return soup
 
-handleMacro = {
-    'code' : code_macro,
-    'details' : details_macro,
-    'noformat': code_macro,
-    'gallery': gallery_macro,
-    'toc' : toc_macro,
-    'attachments': attachments_macro,
-    'expand': null_macro,
-    # consider adding the columns plugin to DokuWiki and generating the
-    # appropriate markup
-    'anchor' : null_macro,
-    'section': section_macro,
-    'column': column_macro,
-    'panel' : panel_macro,
-    'children': subpages_macro,
-    'status':status_macro,
-    'info': info_macro,
-    'tip': tip_macro,
-    'note': note_macro,
-    'warning': warning_macro,
-    'danger': danger_macro
-    }
+# Macros with no handler are shown as their storage format
+def unhandled_macro(soup, page):
+    x = re.sub(r'<', r'&#60;', str(soup))
+    x = re.sub(r'>', r'&#62;', x)
+    pre = new_soup().new_tag('pre')
+    pre.append(x)
+    return pre
+
+class MacroRegistry:
+    """
+    The handlers for Confluence macros, by macro name. A handler takes
+    the macro's tag and the Page, and returns what replaces the macro:
+    a tag, a soup or a string. Handlers registered as cacheable depend
+    only on the macro, not on the page it is in, so what they make can
+    be rendered once for every page with the same macro.
+    """
+    def __init__(self):
+        self.handlers = {}
+        self.cacheable = set()
+        self.unhandled = unhandled_macro
+        self.unhandled_cacheable = True
+
+    def register(self, name, handler, cacheable=False):
+        self.handlers[name] = handler
+        if cacheable:
+            self.cacheable.add(name)
+        else:
+            self.cacheable.discard(name)
+
+    # for macros no handler is registered for
+    def register_unhandled(self, handler, cacheable=False):
+        self.unhandled = handler
+        self.unhandled_cacheable = cacheable
+
+    # Load handlers from a module, by name or .py file, which defines
+    # register_macros(registry)
+    def load(self, module):
+        # run as a script this is __main__; the module's "import extract"
+        # is to find it, not load a second copy nothing reads
+        sys.modules.setdefault('extract', sys.modules[__name__])
+        try:
+            if module.endswith('.py'):
+                spec = importlib.util.spec_from_file_location(
+                    os.path.splitext(os.path.basename(module))[0], module)
+                mod = importlib.util.module_from_spec(spec)
+                spec.loader.exec_module(mod)
+            else:
+                mod = importlib.import_module(module)
+        except (ImportError, OSError) as e:
+            print("Can't load macros from %s: %s" % (module, e))
+            sys.exit(1)
+        if not hasattr(mod, 'register_macros'):
+            print('%s has no register_macros(registry)' % module)
+            sys.exit(1)
+        mod.register_macros(self)
+
+    def cacheable_name(self, name):
+        if name in self.handlers:
+            return name in self.cacheable
+        return self.unhandled_cacheable
+
+    # whether what a macro turns into depends only on its content: its
+    # handler and those of all the macros in it are cacheable
+    def is_cacheable(self, cc):
+        if not self.cacheable_name(cc.get('ac:name')):
+            return False
+        return all(self.cacheable_name(inner.get('ac:name'))
+                   for inner in cc.find_all('ac:structured-macro'))
+
+macros = MacroRegistry()
+for name, handler in (
+        ('code', code_macro),
+        ('details', details_macro),
+        ('noformat', code_macro),
+        ('gallery', gallery_macro),
+        ('expand', null_macro),
+        # consider adding the columns plugin to DokuWiki and generating the
+        # appropriate markup
+        ('anchor', null_macro),
+        ('section', section_macro),
+        ('column', column_macro),
+        ('panel', panel_macro),
+        ('status', status_macro),
+        ('info', info_macro),
+        ('tip', tip_macro),
+        ('note', note_macro),
+        ('warning', warning_macro),
+        ('danger', danger_macro)):
+    macros.register(name, handler, cacheable=True)
+# these depend on the page
+macros.register('toc', toc_macro)
+macros.register('attachments', attachments_macro)
+macros.register('children', subpages_macro)
 
 # run this before markdownify.
 # 'confluence' is the PageContent for a page
 # this is for processing some special things before html2markdown
 # by converting some special confluence macros into normal HTML
 def convert(confluence, page):
+    soup = rewrite(confluence, page)
+    if soup.is_xml:
+        # without the <?xml?> declaration str() would start with
+        return ''.join(c.decode() if isinstance(c, Tag) else c.output_ready() for c in soup.contents)
+    return str(soup)
+
+# The rewritten soup, which either engine renders
+def rewrite(confluence, page):
     if confluence == '':
         return make_toc_page(page)
-    soup = BeautifulSoup(confluence, "html.parser")
+    if fragmentCache is not None:
+        confluence = fragmentCache.prepare(confluence, page)
+    soup = parse_storage(confluence)
     title = soup.new_tag("h1")
     title.string = page.title
     soup.insert(0, title)
 
     if len(page.children):
-        toc = BeautifulSoup("")
+        toc = new_soup()
         toc = make_toc(page, toc)
         soup.insert(1, toc)
 
+    found = collect_rewrites(soup)
+
     # Users
-    allusers = soup.find_all('ri:user')
-    for ll in allusers:
-        try:
-            user = get_user(ll['ri:userkey'])
-            if user is None:
-                username = 'UnknownUser'
-        except KeyError:
-            try:
-                user = None
-                username = ll['ri:username']
-            except KeyError:
-                print (ll)
-                raise Exception("malformed user")
-       
-        pp=ll.parent
-        if pp.name == 'ac:link':
-            if user:
-                pp.replace_with('[[user>%s|%s]]' % (user.userid, user.name))
-            else:
-                pp.replace_with('@' + username)
-        else:
-            raise Exception("User found that is not a link")
+    for ll in in_tree(found['users'], soup):
+        rewrite_user(ll, page)
 
     # Attachments
-    unhandled = set(page.attaches)
-    allattachments = soup.find_all('ri:attachment')
-    for ll in allattachments:
-        link_filename = ll['ri:filename']
-        pp=ll.parent
-        if link_filename in attachmentIndex:
-            id = attachmentIndex[link_filename]
-            if id in unhandled:
-                unhandled.remove(id)
-        parent_id = ll.find('ri:content-entity')
-        if parent_id:
-            if parent_id in pages:
-                apage  = pages[parent_id['ri:content-id']]
-            else:
-                # reference is to a page outside the dump
-                apage = page 
-        else:
-            apage = page
-        if pp.name == 'ac:link':
-            pp.replace_with(make_attachment_link(link_filename, soup, apage))
-        elif pp.name == 'ac:image':
-            pp.replace_with(make_attachment_image(link_filename, soup, apage))
-        elif hasattr(pp.parent, 'ac:name') and \
-            pp.parent['ac:name'] == 'view-file' or pp.parent['ac:name'] == 'viewpdf':
-            # other types of file embeds, which we will just make into attachment links
-            pp.replace_with(make_attachment_link(link_filename, soup, apage))
-        else:
-            print ("unrecognised attachment:")
-            print(pp)
-            print (pp.parent)
-            raise Exception("Attachment found that is neither link nor image")
+    # a dict rather than a set, to keep the attachment index in page order
+    unhandled = dict.fromkeys(page.attaches)
+    for ll in in_tree(found['attachments'], soup):
+        rewrite_attachment(ll, soup, page, unhandled)
 
     soup.append(make_attachment_index(page, unhandled))
 
+    rewrite_content(found, soup, page)
+    for ff in found['fragments']:
+        pagePlaceholders[id(ff)] = (ff, ff['key'], page)
+    return soup
+
+# The rest of rewrite(), which the fragment cache also runs on a macro
+# by itself
+def rewrite_content(found, soup, page):
     # Internal Links
-    allintlinks = soup.find_all('ri:page')
-    if (len(allintlinks)):
-        for link in allintlinks:
-            pp = link.parent
-            if (pp.name == 'ac:link'):
-                linkedPageTitle = link['ri:content-title']
-                if linkedPageTitle in pageNames:
-                    pp.replace_with(make_internal_link_p(pageNames[linkedPageTitle], soup))
-                else:
-                    print('%s not in pageNames' % linkedPageTitle)
-                    pp.replace_with(make_internal_link(linkedPageTitle, soup))
-            else:
-                raise Exception("Page found that is not a link")
+    for link in in_tree(found['links'], soup):
+        rewrite_page_link(link, soup)
 
     # Task lists
-    tlists = soup.find_all('ac:task-list')
-    if (len(tlists)):
-        for tl in tlists:
-            for task in tl.find_all('ac:task'):
-                #TODO: due dates
-                taskid = task.find("ac:task-id")
-                body = task.find("ac:task-body")
-                status = task.find("ac:task-status") or None
-                task.name = "li"
-                taskid.decompose()
-                completed = False
-                if (status and status.getText() == "complete"):
-                    completed = True
-                status.decompose()
-                if (completed):
-                    body.insert(0, "[COMPLETE] ")
-            tl.name = "ul"
+    for task in in_tree(found['tasks'], soup):
+        rewrite_task(task)
+    for tl in in_tree(found['tasklists'], soup):
+        tl.name = "ul"
 
     #emoticons 1
-    emoticons = soup.find_all(attrs = {"class": "emoticon"})
-    if len(emoticons):
-        for em in emoticons:
-            ti = em.attrs["title"].strip('():')
-            if ti in emoticons_symbols:
-                em.replace_with(emoticons_symbols[ti])
-            else:
-                print("Unknown emoticon :%s:" % ti)
-                em.replace_with(':%s:' % ti)
-
-    emoticons = soup.find_all('ac:emoticon')
-    if len(emoticons):
-        for em in emoticons:
-            ti = em['ac:name']
-            if ti in emoticons_symbols:
-                em.replace_with(emoticons_symbols[ti])
-            else:
-                print("Unknown emoticon :%s:" % ti)
-                em.replace_with(':%s:' % ti)
+    for em in in_tree(found['class_emoticons'], soup):
+        rewrite_emoticon(em, em.attrs["title"].strip('():'))
 
+    for em in in_tree(found['emoticons'], soup):
+        rewrite_emoticon(em, em['ac:name'])
 
     # macros blocks
-    macros = soup.find_all('ac:structured-macro')
-    if len(macros):
-        for cc in macros:
-            name = cc['ac:name']
-            if name in handleMacro:
-                print('macro ' + name)
-                cc.replace_with(handleMacro[name](cc, page))
-            else:
-                print("Unhandled macro %s in page '%s'" % (
-                    name, page.title))
-                x = re.sub(r'<', r'&#60;', str(cc))
-                x = re.sub(r'>', r'&#62;', x)
-                cc.wrap(soup.new_tag('pre'))
-                cc.replace_with(x)
-                
-            
-    return str(soup)
+    # Outermost first. A handler may move an inner macro into its
+    # result without it being in the tree any more, so take the list
+    # up front rather than checking each macro as we get to it.
+    for cc in list(in_tree(found['macros'], soup)):
+        rewrite_macro(cc, soup, page)
+
+# Which list each tag goes in, for the rewrite pass in convert()
+rewriteTags = {
+    'ri:user': 'users',
+    'ri:attachment': 'attachments',
+    'ri:page': 'links',
+    'ac:task-list': 'tasklists',
+    'ac:task': 'tasks',
+    'ac:emoticon': 'emoticons',
+    'ac:structured-macro': 'macros',
+    fragmentTag: 'fragments',
+    }
 
-# given a Page, build a filepath for that page,
-# with intelligent folder structure
-def build_path(page: Page):
-    status = page.status
-    pathname = [page.filename]
-    while page.parent is not None:
-        page = pages[page.parent]
-        pathname.insert(0, page.filename)
-    pathname.insert(0, status)
-    pathname.insert(0, 'Pages')
-    pathname = '/'.join(pathname)
-    return pathname.lower()
+# Walk the page once, sorting the tags we rewrite by kind, in document order
+def collect_rewrites(soup):
+    found = dict((kind, []) for kind in rewriteTags.values())
+    found['class_emoticons'] = []
+    for node in soup.descendants:
+        if not isinstance(node, Tag):
+            continue
+        if node.name in rewriteTags:
+            found[rewriteTags[node.name]].append(node)
+        classes = node.get('class')
+        if classes:
+            if isinstance(classes, str):
+                classes = classes.split()
+            if 'emoticon' in classes:
+                found['class_emoticons'].append(node)
+    return found
+
+# the nodes that are still part of the soup, i.e. were not
+# replaced along with an ancestor by an earlier rewrite
+def in_tree(nodes, soup):
+    for node in nodes:
+        top = node
+        while top.parent is not None:
+            top = top.parent
+        if top is soup:
+            yield node
+
+def rewrite_user(ll, page):
+    try:
+        user = get_user(ll['ri:userkey'])
+        if user is None:
+            username = 'UnknownUser'
+    except KeyError:
+        try:
+            user = None
+            username = ll['ri:username']
+        except KeyError:
+            print (ll)
+            raise Exception("malformed user")
 
-# ------------ load entities.xml ------------
+    pp=ll.parent
+    if pp.name == 'ac:link':
+        if user:
+            pp.replace_with('[[user>%s|%s]]' % (user.userid, user.name))
+        else:
+            pp.replace_with('@' + username)
+    else:
+        raise Exception("User found that is not a link")
+
+def rewrite_attachment(ll, soup, page, unhandled):
+    link_filename = ll['ri:filename']
+    pp=ll.parent
+    if link_filename in page.attachByName:
+        unhandled.pop(page.attachByName[link_filename], None)
+    parent_id = ll.find('ri:content-entity')
+    if parent_id:
+        if parent_id.get('ri:content-id') in pages:
+            apage  = pages[parent_id['ri:content-id']]
+        else:
+            # reference is to a page outside the dump
+            apage = page
+    else:
+        apage = page
+    if pp.name == 'ac:link':
+        pp.replace_with(make_attachment_link(link_filename, soup, apage))
+    elif pp.name == 'ac:image':
+        pp.replace_with(make_attachment_image(link_filename, soup, apage))
+    elif hasattr(pp.parent, 'ac:name') and \
+        pp.parent['ac:name'] == 'view-file' or pp.parent['ac:name'] == 'viewpdf':
+        # other types of file embeds, which we will just make into attachment links
+        pp.replace_with(make_attachment_link(link_filename, soup, apage))
+    else:
+        print ("unrecognised attachment:")
+        print(pp)
+        print (pp.parent)
+        raise Exception("Attachment found that is neither link nor image")
+
+def rewrite_page_link(link, soup):
+    pp = link.parent
+    if (pp.name == 'ac:link'):
+        linkedPageTitle = link['ri:content-title']
+        pageState.linked_titles.append(linkedPageTitle)
+        if linkedPageTitle in linkGraph.markup:
+            pp.replace_with(linkGraph.markup[linkedPageTitle])
+        elif linkedPageTitle in pageNames:
+            pp.replace_with(make_internal_link_p(pageNames[linkedPageTitle], soup))
+        else:
+            warn('%s not in pageNames' % linkedPageTitle)
+            pp.replace_with(make_internal_link(linkedPageTitle, soup))
+    else:
+        raise Exception("Page found that is not a link")
+
+def rewrite_task(task):
+    #TODO: due dates
+    taskid = task.find("ac:task-id")
+    body = task.find("ac:task-body")
+    status = task.find("ac:task-status") or None
+    task.name = "li"
+    if taskid:
+        taskid.decompose()
+    completed = False
+    if (status and status.getText() == "complete"):
+        completed = True
+    if status:
+        status.decompose()
+    if (completed):
+        body.insert(0, "[COMPLETE] ")
+
+def rewrite_emoticon(em, ti):
+    if ti in emoticons_symbols:
+        em.replace_with(emoticons_symbols[ti])
+    else:
+        warn("Unknown emoticon :%s:" % ti)
+        em.replace_with(':%s:' % ti)
+
+def rewrite_macro(cc, soup, page):
+    name = cc['ac:name']
+    key = cc.attrs.pop(fragmentKey, None)
+    names = None
+    if fragmentCache is not None:
+        if key is not None and macros.is_cacheable(cc):
+            names = [name]
+            # macros in it still get rewritten when its handler drops them
+            pageFragments[id(cc)] = (cc, key, names)
+        else:
+            # a macro inside one the fragment cache will have
+            for parent in cc.parents:
+                if id(parent) in pageFragments:
+                    pageFragments[id(parent)][2].append(name)
+                    break
+    start = time.perf_counter()
+    if name in macros.handlers:
+        pageState.macros[name] = pageState.macros.get(name, 0) + 1
+        result = macros.handlers[name](cc, page)
+    else:
+        pageState.unhandled_macros[name] = pageState.unhandled_macros.get(name, 0) + 1
+        warn("Unhandled macro %s in page '%s'" % (
+            name, page.title))
+        result = macros.unhandled(cc, page)
+    pageState.macro_times[name] = pageState.macro_times.get(name, 0) + time.perf_counter() - start
+    if names is not None:
+        # the one tag the macro turned into, if it did
+        top = result
+        if isinstance(result, BeautifulSoup) and len(result.contents) == 1:
+            top = result.contents[0]
+        if (isinstance(top, Tag) and not isinstance(top, BeautifulSoup) and
+            top.name not in contextTags):
+            pageFragments[id(top)] = (top, key, names)
+    cc.replace_with(result)
+
+# ------------ native renderer ------------
+
+# --engine native renders the soup rewrite() makes straight to the
+# markup md() would make of it, rather than serializing the soup for
+# markdownify to parse again. tools/diff_engines.py compares the two.
+
+renderEngine = 'markdownify'
+
+# The markdownify the renderer makes the same markup as. Its escaping,
+# list, heading and table rules are copied from that version, and newer
+# ones change them, so --engine native is refused with any other.
+markdownifyVersion = '0.13.1'
+
+def installed_markdownify():
+    try:
+        return importlib.metadata.version('markdownify')
+    except importlib.metadata.PackageNotFoundError:
+        return None
+
+nestedTags = set(['ol', 'ul', 'li', 'table', 'thead', 'tbody', 'tfoot', 'tr', 'td', 'th'])
+codeTags = set(['pre', 'code', 'kbd', 'samp'])
+headingTag = re.compile(r'h[1-6]')
+headingLevel = re.compile(r'h(\d+)')
+blanks = re.compile(r'[\t ]+')
+lineStart = re.compile(r'^', re.MULTILINE)
+escapeMisc = re.compile(r'([\\&<`[>~#=+|-])')
+escapeNumbered = re.compile(r'([0-9])([.)])')
+
+# move leading and trailing spaces of inline markup outside it
+def chomp(text):
+    prefix = ' ' if text and text[0] == ' ' else ''
+    suffix = ' ' if text and text[-1] == ' ' else ''
+    return prefix, suffix, text.strip()
+
+def is_nested(el):
+    return el and el.name in nestedTags
+
+# Make the tree look as it would parsed back from str(soup): adjacent
+# strings left by the rewrites merged, empty ones dropped
+def tidy_strings(soup):
+    stack = [soup]
+    while stack:
+        node = stack.pop()
+        prev = None
+        for el in list(node.contents):
+            if isinstance(el, Tag):
+                stack.append(el)
+                prev = None
+            elif type(el) is NavigableString:
+                if el == '':
+                    el.extract()
+                elif prev is not None:
+                    merged = NavigableString(prev + el)
+                    prev.replace_with(merged)
+                    el.extract()
+                    prev = merged
+                else:
+                    prev = el
+            else:
+                prev = None
 
-print('Loading "entities.xml" from current directory... ', end='')
+class DokuWikiRenderer:
+    """
+    Renders a rewritten page to the same markup as md(), following
+    markdownify's rules for the tags pages contain
+    """
+    bullets = '*+-'
+
+    def __init__(self):
+        inline = self.inline
+        self.inline_code = inline('`')
+        self.converters = {
+            'a': lambda el, text, as_inline, in_code: link_markup(el, text),
+            'panel': lambda el, text, as_inline, in_code: panel_markup(el, text),
+            'b': inline('**'), 'strong': inline('**'),
+            'em': inline('*'), 'i': inline('*'),
+            'del': inline('~~'), 's': inline('~~'),
+            'sub': inline(''), 'sup': inline(''),
+            'code': self.convert_code, 'kbd': self.convert_code, 'samp': self.convert_code,
+            'blockquote': self.convert_blockquote,
+            'br': self.convert_br,
+            'hr': lambda el, text, as_inline, in_code: '\n\n---\n\n',
+            'img': self.convert_img,
+            'list': self.convert_list, 'ul': self.convert_list, 'ol': self.convert_list,
+            'li': self.convert_li,
+            'p': self.convert_p,
+            'pre': self.convert_pre,
+            'script': lambda el, text, as_inline, in_code: '',
+            'style': lambda el, text, as_inline, in_code: '',
+            'table': lambda el, text, as_inline, in_code: '\n\n' + text + '\n',
+            'caption': lambda el, text, as_inline, in_code: text + '\n',
+            'figcaption': lambda el, text, as_inline, in_code: '\n\n' + text + '\n\n',
+            'td': self.convert_cell, 'th': self.convert_cell,
+            'tr': self.convert_tr,
+            }
+
+    def render(self, soup):
+        tidy_strings(soup)
+        return self.render_children(soup, False, False, False)
+
+    def render_children(self, node, as_inline, in_pre, in_code):
+        if node.name in nestedTags:
+            # whitespace between list items and table cells
+            for el in node.children:
+                if (isinstance(el, NavigableString) and el.strip() == '' and
+                    (not el.previous_sibling or not el.next_sibling or
+                     is_nested(el.previous_sibling) or is_nested(el.next_sibling))):
+                    el.extract()
+        out = []
+        for el in node.children:
+            if isinstance(el, (Comment, Doctype)):
+                continue
+            elif isinstance(el, NavigableString):
+                out.append(self.render_text(el, in_pre, in_code))
+            else:
+                out.append(self.render_tag(el, as_inline, in_pre, in_code))
+        return ''.join(out)
+
+    def render_tag(self, el, as_inline, in_pre, in_code):
+        if id(el) in pageFragments or id(el) in pagePlaceholders:
+            return self.render_fragment(el, as_inline, in_pre, in_code)
+        name = el.name
+        # headings and table cells can't hold block markup
+        text = self.render_children(
+            el, as_inline or name in ('td', 'th') or headingTag.match(name) is not None,
+            in_pre or name == 'pre', in_code or name in codeTags)
+        convert = self.converters.get(name)
+        if convert:
+            return convert(el, text, as_inline, in_code)
+        level = headingLevel.match(name)
+        if level:
+            return self.convert_heading(int(level.group(1)), text, as_inline)
+        return text
+
+    # What a macro turned into, rendered once for each content and each
+    # context it can be rendered differently in
+    def render_fragment(self, el, as_inline, in_pre, in_code):
+        placeholder = pagePlaceholders.pop(id(el), None)
+        if placeholder:
+            el, key, page = placeholder
+            names = None
+        else:
+            el, key, names = pageFragments.pop(id(el))
+        # lists render by how deep they are in other lists
+        depth = 0
+        in_li = False
+        for parent in el.parents:
+            if parent.name == 'ul':
+                depth += 1
+            elif parent.name == 'li':
+                in_li = True
+        context = (as_inline, in_pre, in_code, depth, in_li)
+        text = fragmentCache.get(key, context)
+        if text is None:
+            if placeholder:
+                # in a context the macro has not been in
+                top = fragmentCache.expand(key, page)
+                el.replace_with(top)
+                el = top
+            text = self.render_tag(el, as_inline, in_pre, in_code)
+            fragmentCache.put(key, context, text, names)
+        return text
+
+    def render_text(self, el, in_pre, in_code):
+        text = str(el)
+        if not in_pre:
+            text = blanks.sub(' ', text)
+        if not in_code:
+            text = self.escape(text)
+        if el.parent.name == 'li' and (not el.next_sibling or el.next_sibling.name in ['ul', 'ol']):
+            text = text.rstrip()
+        return text
+
+    def escape(self, text):
+        if not text:
+            return ''
+        text = escapeMisc.sub(r'\\\1', text)
+        text = escapeNumbered.sub(r'\1\\\2', text)
+        return text.replace('*', r'\*').replace('_', r'\_')
+
+    def inline(self, markup):
+        def convert(el, text, as_inline, in_code):
+            if in_code:
+                return text
+            prefix, suffix, text = chomp(text)
+            if not text:
+                return ''
+            return prefix + markup + text + markup + suffix
+        return convert
+
+    def convert_code(self, el, text, as_inline, in_code):
+        if el.parent.name == 'pre':
+            return text
+        return self.inline_code(el, text, as_inline, in_code)
+
+    def convert_blockquote(self, el, text, as_inline, in_code):
+        if as_inline:
+            return text
+        return '\n' + (lineStart.sub('> ', text.strip()) + '\n\n') if text else ''
+
+    def convert_br(self, el, text, as_inline, in_code):
+        return '' if as_inline else '  \n'
+
+    def convert_heading(self, n, text, as_inline):
+        if as_inline:
+            return text
+        text = text.strip()
+        if n <= 2:
+            return '%s\n%s\n\n' % (text, ('=' if n == 1 else '-') * len(text)) if text else ''
+        return '%s %s\n\n' % ('#' * n, text)
+
+    def convert_img(self, el, text, as_inline, in_code):
+        alt = el.attrs.get('alt', None) or ''
+        src = el.attrs.get('src', None) or ''
+        title = el.attrs.get('title', None) or ''
+        title_part = ' "%s"' % title.replace('"', r'\"') if title else ''
+        if as_inline:
+            return alt
+        return '![%s](%s%s)' % (alt, src, title_part)
+
+    def convert_list(self, el, text, as_inline, in_code):
+        before_paragraph = el.next_sibling and el.next_sibling.name not in ['ul', 'ol']
+        while el:
+            if el.name == 'li':
+                # nested: indent, and no trailing newline
+                return '\n' + (lineStart.sub('\t', text) if text else '').rstrip()
+            el = el.parent
+        return text + ('\n' if before_paragraph else '')
+
+    def convert_li(self, el, text, as_inline, in_code):
+        parent = el.parent
+        if parent is not None and parent.name == 'ol':
+            start = parent.get('start')
+            start = int(start) if start and str(start).isnumeric() else 1
+            bullet = '%s.' % (start + parent.index(el))
+        else:
+            depth = -1
+            while el:
+                if el.name == 'ul':
+                    depth += 1
+                el = el.parent
+            bullet = self.bullets[depth % len(self.bullets)]
+        return '%s %s\n' % (bullet, (text or '').strip())
+
+    def convert_p(self, el, text, as_inline, in_code):
+        if as_inline:
+            return text
+        return '%s\n\n' % text if text else ''
+
+    def convert_pre(self, el, text, as_inline, in_code):
+        if not text:
+            return ''
+        return '\n```\n%s\n```\n' % text
+
+    def convert_cell(self, el, text, as_inline, in_code):
+        colspan = 1
+        if 'colspan' in el.attrs and el['colspan'].isdigit():
+            colspan = int(el['colspan'])
+        return ' ' + text.strip().replace('\n', ' ') + ' |' * colspan
+
+    def convert_tr(self, el, text, as_inline, in_code):
+        cells = el.find_all(['td', 'th'])
+        first = not el.previous_sibling
+        parent = el.parent
+        is_headrow = (all(cell.name == 'th' for cell in cells) or
+                      (first and parent.name != 'tbody') or
+                      (first and parent.name == 'tbody' and len(parent.parent.find_all(['thead'])) < 1))
+        overline = ''
+        underline = ''
+        if is_headrow and first:
+            width = 0
+            for cell in cells:
+                if 'colspan' in cell.attrs and cell['colspan'].isdigit():
+                    width += int(cell['colspan'])
+                else:
+                    width += 1
+            underline = '| ' + ' | '.join(['---'] * width) + ' |\n'
+        elif first and (parent.name == 'table' or
+                        (parent.name == 'tbody' and not parent.previous_sibling)):
+            # a table without a heading row gets an empty one
+            overline = '| ' + ' | '.join([''] * len(cells)) + ' |\n'
+            overline += '| ' + ' | '.join(['---'] * len(cells)) + ' |\n'
+        return overline + '|' + text + '\n' + underline
 
-tree=ET.parse('entities.xml')
-root=tree.getroot()
+renderer = DokuWikiRenderer()
 
-print('Done.')
+# Each outermost macro in a page body, as storage format
+storageMacro = re.compile(r'<ac:structured-macro\b[^>]*?(/?)>|</ac:structured-macro>')
 
-if root.tag != 'hibernate-generic':
-    print('not a Confluence export')
-    sys.exit(1)
+class Fragment:
+    """
+    What a macro rendered to, in each context it was rendered in, and
+    what else rewriting it did to the page: the titles it linked to,
+    and the macros it counted
+    """
+    def __init__(self, storage, names):
+        self.storage = storage
+        self.titles = [ref[1] for ref in references(storage) if ref[0] == 'page']
+        self.names = names
+        # context -> markup
+        self.texts = {}
+
+    # what rewriting the macro would have done to the page
+    def replay(self, page):
+        for title in self.titles:
+            pageState.linked_titles.append(title)
+            if title not in linkGraph.markup and title not in pageNames:
+                warn('%s not in pageNames' % title)
+        for name in self.names:
+            if name in macros.handlers:
+                pageState.macros[name] = pageState.macros.get(name, 0) + 1
+            else:
+                pageState.unhandled_macros[name] = pageState.unhandled_macros.get(name, 0) + 1
+                warn("Unhandled macro %s in page '%s'" % (name, page.title))
 
-print ('Confluence export recognised')
+class FragmentCache:
+    """
+    Least recently used cache of what macros render to, holding up to
+    size of them, keyed by the macro's storage format. A page body's
+    macros are looked up before it is parsed, and the ones the cache
+    has are replaced by a placeholder the renderer fills in, so are not
+    parsed, rewritten or rendered again.
+    """
+    def __init__(self, size):
+        self.size = size
+        # key -> Fragment
+        self.entries = OrderedDict()
+        # key -> storage format or Fragment, for the page being converted
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+
+    # Mark each outermost macro in the body with its key, or replace it
+    # with a placeholder if the cache has it
+    def prepare(self, confluence, page):
+        self.pending.clear()
+        pageFragments.clear()
+        pagePlaceholders.clear()
+        spans = []
+        depth = 0
+        for m in storageMacro.finditer(confluence):
+            if m.group(0).startswith('</'):
+                depth -= 1
+                if depth < 0:
+                    return confluence
+                if depth == 0:
+                    spans.append((start, m.end()))
+            else:
+                if depth == 0:
+                    start = m.start()
+                if m.group(1):
+                    if depth == 0:
+                        spans.append((start, m.end()))
+                else:
+                    depth += 1
+        if depth:
+            return confluence
+        out = []
+        pos = 0
+        for start, end in spans:
+            storage = confluence[start:end]
+            # attachments are looked up in the page
+            if 'ri:attachment' in storage:
+                continue
+            key = hashlib.sha1(storage.encode('utf-8')).hexdigest()
+            out.append(confluence[pos:start])
+            pos = end
+            fragment = self.entries.get(key)
+            if fragment is None:
+                self.pending[key] = storage
+                out.append('<ac:structured-macro %s="%s"' % (fragmentKey, key))
+                out.append(storage[len('<ac:structured-macro'):])
+            else:
+                self.entries.move_to_end(key)
+                self.pending[key] = fragment
+                fragment.replay(page)
+                out.append('<%s key="%s"></%s>' % (fragmentTag, key, fragmentTag))
+        out.append(confluence[pos:])
+        return ''.join(out)
+
+    def get(self, key, context):
+        fragment = self.entries.get(key)
+        text = fragment.texts.get(context) if fragment else None
+        if text is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return text
+
+    # names is None for a macro that was a placeholder
+    def put(self, key, context, text, names):
+        fragment = self.pending[key]
+        if not isinstance(fragment, Fragment):
+            fragment = self.entries.get(key) or Fragment(fragment, names)
+        self.entries[key] = fragment
+        fragment.texts[context] = text
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    # Rewrite the macro a placeholder on page stands for, into a state
+    # of its own, as replay() has already counted it and warned about it
+    def expand(self, key, page):
+        global pageState
+        state = pageState
+        pageState = PageState()
+        try:
+            soup = parse_storage(self.pending[key].storage)
+            found = collect_rewrites(soup)
+            for ll in in_tree(found['users'], soup):
+                rewrite_user(ll, page)
+            rewrite_content(found, soup, page)
+        finally:
+            pageState = state
+        return soup.contents[0]
+
+# with --macro-cache
+fragmentCache = None
+
+class Hierarchy:
+    """
+    The page tree: works out each page's chain of ancestor filenames
+    once, from its parent's, and walks the tree of exported pages
+    """
+    def __init__(self):
+        # page id -> 'ancestor/.../filename'
+        self.chains = {}
+        self.missing_parents = set()
+        self.cycles = []
+
+    def chain(self, page: Page):
+        if page.id in self.chains:
+            return self.chains[page.id]
+        # climb until we reach a page whose chain is known, or a root
+        climb = [page]
+        on_path = set([page.id])
+        parent = page.parent
+        while parent is not None and parent not in self.chains:
+            if parent not in pages:
+                self.missing_parents.add(parent)
+                print('Page %s: parent %s is not in the export' % (climb[-1].title_or_id(), parent))
+                break
+            if parent in on_path:
+                self.cycles.append(parent)
+                print('Page %s: parent cycle through %s' % (climb[-1].title_or_id(), parent))
+                break
+            on_path.add(parent)
+            climb.append(pages[parent])
+            parent = pages[parent].parent
+        # then come back down, filling in the chains
+        if parent in self.chains:
+            prefix = self.chains[parent] + '/'
+        else:
+            prefix = ''
+        for p in reversed(climb):
+            self.chains[p.id] = prefix + p.filename
+            prefix = self.chains[p.id] + '/'
+        return self.chains[page.id]
+
+    def pathname(self, page: Page):
+        return ('Pages/%s/%s' % (page.status, self.chain(page))).lower()
+
+    # Yield every page in pageNames once, parents before their children,
+    # along with its depth in the tree; or, given roots, only the pages
+    # in their subtrees
+    def walk(self, roots=None):
+        subtrees = roots is not None
+        if roots is None:
+            roots = [p for p in pageNames.values()
+                     if not (p.parent in pages and p.status == "current")]
+        seen = set()
+        stack = [(p, 0) for p in reversed(roots)]
+        while True:
+            while stack:
+                p, depth = stack.pop()
+                if p.id in seen:
+                    continue
+                seen.add(p.id)
+                if p.title in pageNames and pageNames[p.title] is p:
+                    yield p, depth
+                stack.extend((c, depth + 1) for c in reversed(p.children))
+            if subtrees:
+                return
+            # pages whose parent is outside the tree still get visited
+            stack = [(p, 0) for p in reversed(list(pageNames.values())) if p.id not in seen]
+            if not stack:
+                return
+
+hierarchy = Hierarchy()
 
+# given a Page, build a filepath for that page,
+# with intelligent folder structure
+def build_path(page: Page):
+    return hierarchy.pathname(page)
 
-# ------------ find users ------------
-print ('Finding users...')
-users={}
-for obj in root.findall('object[@class="ConfluenceUserImpl"]'):
+# ------------ users ------------
+
+def addUser(obj):
     id = obj.find('id').text
     userid = ''
     email = ''
@@ -631,13 +1488,12 @@ for obj in root.findall('object[@class="ConfluenceUserImpl"]'):
     # create a ConfluenceUser (constructor will add itself to 'users')
     ConfluenceUser(id, email, first, last, userid)
 
-emailcount = sum(1 for x in users if users[x].email)
-print ("Found %s users. %s with email+name, %s without." % (len(users), emailcount, len(users)-emailcount))
-
+def report_users():
+    emailcount = sum(1 for x in users if users[x].email)
+    print ("Found %s users. %s with email+name, %s without." % (len(users), emailcount, len(users)-emailcount))
 
 
-# ------------ prepare attachments ------------
-attachments = {}
+# ------------ attachments ------------
 
 def addAttachment(obj):
     id = obj.find('id').text
@@ -645,14 +1501,7 @@ def addAttachment(obj):
     Attachment(id, title)
 
 
-print('Processing attachments... ', end='')
-for obj in root.findall('object[@class="Attachment"]'):
-    addAttachment(obj)
-print('Done.')
-
-
-# ------------ process pages ------------
-pages = {}
+# ------------ pages ------------
 
 # build a Page object from an XML object for that page
 def addPage(obj, is_blog=False):
@@ -675,23 +1524,48 @@ def addPage(obj, is_blog=False):
         bodyId = body.find('id').text
     status = obj.find('property[@name="contentStatus"]').text
 
-    # create a list of associated attachments
+    # create a list of associated attachment ids; these are turned into
+    # Attachment objects by resolve_attachments() once everything is
+    # loaded, as a streamed export may list an attachment after its page
     attaches = []
     attachcoll = obj.find('collection[@name="attachments"]')
     if attachcoll:
         for att in attachcoll.findall('element[@class="Attachment"]'):
-            attachid = att.find('id').text
-            attaches.append(attachments[attachid])
-    
+            attaches.append(att.find('id').text)
+
     # create a Page (will add itself to 'pages')
     pp = Page(id, parent, version, bodyId, title, status, attaches)
+    pp.is_blog = is_blog
+    modified = obj.find('property[@name="lastModificationDate"]')
+    if modified is not None:
+        pp.modified = modified.text
+    modifier = obj.find('property[@name="lastModifier"]/id')
+    if modifier is not None:
+        pp.modifier = modifier.text
+    comment = obj.find('property[@name="versionComment"]')
+    if comment is not None:
+        pp.comment = comment.text or ''
     oldVersions = obj.find('collection[@name="historicalVersions"]')
     if oldVersions is None:
         return
     for v in oldVersions.findall('element[@class="Page"]'):
         oldId = v.find('id').text
         pp.history.append(oldId)
-        outDated.append(oldId)
+        outDated.add(oldId)
+
+def addBlogPost(obj):
+    addPage(obj, True)
+
+# the 'root' blog post, parent of all the others
+def addBlogRoot():
+    pages["0"] = Page("0", None, "0", "0", "Blog Posts", "current", [])
+
+def resolve_attachments():
+    for p in pages.values():
+        p.attaches = [attachments[a] for a in p.attaches]
+        # the first attachment with a given title wins, as in a linear search
+        for a in reversed(p.attaches):
+            p.attachByName[a.title] = a
 
 def page_name_to_filename(pagename):
     s = pagename.replace('/', '-').replace(' ', '_')
@@ -700,93 +1574,2044 @@ def page_name_to_filename(pagename):
     return s
 
 
-report_empty_pages = False
-
-# find all pages
-print('Grabbing raw pages... ', end='')
-for obj in root.findall('object[@class="Page"]'):
-    addPage(obj)
-print('Done.')
-if report_empty_pages:
-    pages_without_content = [pages[x].title_or_id() for x in pages if pages[x].bodyId=='0']
-    if (len(pages_without_content)):
-        print('The following pages have no content: ', pages_without_content)
-
-# find all blog posts
-# first, create the 'root' blog post
-pages["0"] = Page("0", None, "0", "0", "Blog Posts", "current", [])
-print('Grabbing raw blog posts... ', end='')
-for obj in root.findall('object[@class="BlogPost"]'):
-    addPage(obj, True)
-print('Done.')
-if report_empty_pages:
-    blogs_without_content = [pages[x].title_or_id() for x in pages if pages[x].bodyId=='0']
-    if (len(blogs_without_content)):
-        print('The following pages have no content: ', blogs_without_content)
+# ------------ page content ------------
 
+# BodyContent id -> the references in it, as references() yields them,
+# kept in a BodyStore: found while each body is loaded, so the link
+# graph is built without reading the bodies from the store again. With
+# the bodies in memory there is none; the link graph finds them in the
+# latest versions' bodies, leaving the older versions' alone.
+PageReferences = None
 
-# index all the BodyContent objects
-PageContent = {}
-for obj in root.findall('object[@class="BodyContent"]'):
+def addBodyContent(obj):
     id = obj.find('id').text
     content = obj.find('property[@name="body"]').text or ''
     PageContent[id] = content
+    if PageReferences is not None:
+        PageReferences[id] = list(references(content))
+
+class BodyStore:
+    """
+    SQLite store of BodyContent bodies, keyed by BodyContent id.
+    It also keeps the XML of every other object loaded from the
+    export, so a rerun can be loaded from here instead of entities.xml
+    """
+    def __init__(self, filename=None):
+        if filename is None:
+            self.tmpdir = tempfile.TemporaryDirectory()
+            filename = os.path.join(self.tmpdir.name, 'bodies.sqlite')
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.execute('PRAGMA synchronous=OFF')
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS body (id TEXT PRIMARY KEY, content TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS refs (id TEXT PRIMARY KEY, refs TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS object (class TEXT NOT NULL, xml BLOB NOT NULL);
+            CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT);
+        ''')
+        self.refs = StoredReferences(self)
+
+    def __setitem__(self, id, content):
+        self.db.execute('INSERT OR REPLACE INTO body VALUES (?, ?)', (id, content))
+
+    def __getitem__(self, id):
+        row = self.db.execute('SELECT content FROM body WHERE id = ?', (id,)).fetchone()
+        if row is None:
+            raise KeyError(id)
+        return row[0]
+
+    def __contains__(self, id):
+        return self.db.execute('SELECT 1 FROM body WHERE id = ?', (id,)).fetchone() is not None
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM body').fetchone()[0]
+
+    def add_object(self, obj):
+        self.db.execute('INSERT INTO object VALUES (?, ?)', (obj.get('class'), ET.tostring(obj)))
+
+    def objects(self):
+        for (xml,) in self.db.execute('SELECT xml FROM object ORDER BY rowid'):
+            yield ET.fromstring(xml)
+
+    # 'source' identifies the entities.xml the store was completely built from
+    def source(self):
+        row = self.db.execute("SELECT value FROM info WHERE key = 'source'").fetchone()
+        return row and row[0]
+
+    def reopen(self):
+        self.db = sqlite3.connect(self.filename)
+
+    def clear(self):
+        self.db.executescript('DELETE FROM info; DELETE FROM body; DELETE FROM refs; DELETE FROM object;')
+
+    def finish(self, source):
+        self.db.execute("INSERT OR REPLACE INTO info VALUES ('source', ?)", (source,))
+        self.db.commit()
+
+class StoredReferences:
+    """
+    The references in the bodies of a BodyStore, kept in it as JSON,
+    for PageReferences
+    """
+    def __init__(self, store):
+        self.store = store
+
+    def __setitem__(self, id, refs):
+        self.store.db.execute('INSERT OR REPLACE INTO refs VALUES (?, ?)', (id, json.dumps(refs)))
+
+    def get(self, id):
+        row = self.store.db.execute('SELECT refs FROM refs WHERE id = ?', (id,)).fetchone()
+        return row and [tuple(ref) for ref in json.loads(row[0])]
+
+# Cheap identity of an export file, to tell whether a store is up to date
+def export_signature(filename):
+    try:
+        st = os.stat(filename)
+    except FileNotFoundError:
+        return None
+    return '%d:%d' % (st.st_size, int(st.st_mtime))
+
+
+# ------------ run report ------------
+
+# Where the time and memory of a run go, stage by stage, plus the
+# slowest pages and the macros seen. Written as JSON at the end of
+# each run, so runs against different exports can be compared.
+
+report_file = 'export-report.json'
+slowestPages = 10
+
+# the high-water mark of resident memory, in MiB
+def peak_rss(who=resource.RUSAGE_SELF):
+    return round(resource.getrusage(who).ru_maxrss / 1024, 1)
+
+class RunReport:
+    def __init__(self):
+        self.started = time.time()
+        self.stages = []
+        self.open_stages = []
+        # (seconds, title, pathname, convert seconds, render seconds)
+        self.slowest = []
+        self.macros = {}
+        self.unhandled_macros = {}
+        self.macro_seconds = {}
+        self.fragments = [0, 0]
+        self.sections = {}
+
+    @contextmanager
+    def stage(self, name):
+        # listed in the order they start, under the stage they are part of
+        entry = self.add_stage(name, 0, 0)
+        if self.open_stages:
+            entry['within'] = self.open_stages[-1]
+        self.open_stages.append(name)
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            self.open_stages.pop()
+            entry['wall_seconds'] = round(time.perf_counter() - wall, 4)
+            entry['cpu_seconds'] = round(time.process_time() - cpu, 4)
+            entry['peak_rss_mib'] = peak_rss()
+
+    # stages done page by page, maybe in workers, are added up and
+    # recorded once they are all done
+    def add_stage(self, name, wall, cpu, rss=None):
+        entry = {
+            'stage': name,
+            'wall_seconds': round(wall, 4),
+            'cpu_seconds': round(cpu, 4),
+            'peak_rss_mib': peak_rss() if rss is None else rss,
+        }
+        self.stages.append(entry)
+        return entry
+
+    def add_page(self, exported):
+        total = exported.convert_time[0] + exported.render_time[0]
+        item = (total, exported.title, exported.filename,
+                exported.convert_time[0], exported.render_time[0])
+        if len(self.slowest) < slowestPages:
+            heapq.heappush(self.slowest, item)
+        else:
+            heapq.heappushpop(self.slowest, item)
+        for name, n in exported.macros.items():
+            self.macros[name] = self.macros.get(name, 0) + n
+        for name, n in exported.unhandled_macros.items():
+            self.unhandled_macros[name] = self.unhandled_macros.get(name, 0) + n
+        for name, t in exported.macro_times.items():
+            self.macro_seconds[name] = self.macro_seconds.get(name, 0) + t
+        self.fragments[0] += exported.fragments[0]
+        self.fragments[1] += exported.fragments[1]
+
+    def as_dict(self):
+        return dict(self.sections, **{
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started)),
+            'wall_seconds': round(time.time() - self.started, 4),
+            'cpu_seconds': round(time.process_time(), 4),
+            'peak_rss_mib': peak_rss(),
+            'workers_peak_rss_mib': peak_rss(resource.RUSAGE_CHILDREN),
+            'stages': self.stages,
+            'objects': dict((cls, {'count': count, 'seconds': round(elapsed, 4)})
+                            for cls, (count, elapsed) in objectTimes.items()),
+            'slowest_pages': [{'title': title, 'filename': filename, 'seconds': round(total, 4),
+                               'convert_seconds': round(conv, 4), 'render_seconds': round(rend, 4)}
+                              for total, title, filename, conv, rend in sorted(self.slowest, reverse=True)],
+            'macros': self.macros,
+            'unhandled_macros': self.unhandled_macros,
+            'macro_seconds': dict((name, round(t, 4)) for name, t in self.macro_seconds.items()),
+            'fragment_cache': {'hits': self.fragments[0], 'misses': self.fragments[1]},
+        })
+
+    def print_summary(self):
+        print('%-20s %10s %10s %10s' % ('stage', 'wall (s)', 'cpu (s)', 'peak MiB'))
+        for s in self.stages:
+            name = ('  ' + s['stage']) if 'within' in s else s['stage']
+            print('%-20s %10.2f %10.2f %10.1f' % (
+                name, s['wall_seconds'], s['cpu_seconds'], s['peak_rss_mib']))
+        if self.unhandled_macros:
+            print('Unhandled macros: ' + ', '.join('%s (%s)' % m for m in sorted(self.unhandled_macros.items())))
+        if sum(self.fragments):
+            print('Macro fragments: %s rendered, %s from the cache' % (self.fragments[1], self.fragments[0]))
+
+    def save(self, filename):
+        with open(filename + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self.as_dict(), f, indent=1)
+        os.replace(filename + '.tmp', filename)
+
+runReport = RunReport()
+
+# ------------ export ZIP ------------
+
+# With --zip, the export is read straight from the ZIP file Confluence
+# made, rather than from entities.xml and attachments/ unzipped into
+# the current directory
+exportZip = None
+
+class ZipMember:
+    """
+    An attachment file inside the export ZIP, only extracted when it is
+    placed in the output
+    """
+    def __init__(self, archive, info):
+        self.archive = archive
+        self.info = info
+        self.size = info.file_size
+
+    def open(self):
+        return self.archive.open(self.info)
 
-# Dump pages and content (only first 10 for now)
-count = 0
-totalcount = len(pages)
-percent = int(totalcount/100)
+    def extract_to(self, dst):
+        tmp = os.path.join(os.path.dirname(dst), '.%s.tmp' % os.path.basename(dst))
+        with self.open() as fsrc, open(tmp, 'wb') as fdst:
+            shutil.copyfileobj(fsrc, fdst, 1 << 20)
+        os.replace(tmp, dst)
+
+class ExportZip:
+    """
+    A Confluence export ZIP, indexed once: where entities.xml is, and
+    the highest version of each attachment file, whose members are
+    read from the ZIP as they are needed
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.zip = zipfile.ZipFile(filename)
+        self.entities = None
+        members = self.zip.infolist()
+        for info in members:
+            name = info.filename
+            if name == 'entities.xml' or name.endswith('/entities.xml'):
+                if self.entities is None or len(name) < len(self.entities.filename):
+                    self.entities = info
+        if self.entities is None:
+            print('No entities.xml in "%s"; not a Confluence export' % filename)
+            sys.exit(1)
+        # attachments / PageID / AttachmentID / version, next to entities.xml
+        top = self.entities.filename[:-len('entities.xml')] + 'attachments/'
+        self.files = {}
+        versions = {}
+        for info in members:
+            if not info.filename.startswith(top) or info.is_dir():
+                continue
+            parts = info.filename[len(top):].split('/')
+            if len(parts) != 3 or not parts[2].isdigit():
+                continue
+            key = (parts[0], parts[1])
+            if int(parts[2]) > versions.get(key, -1):
+                versions[key] = int(parts[2])
+                self.files[key] = ZipMember(self.zip, info)
+
+    def open_entities(self):
+        return self.zip.open(self.entities)
+
+    # changes when the ZIP, or the entities.xml in it, does
+    def signature(self):
+        st = os.stat(self.filename)
+        return '%d:%d:%d:%08x' % (st.st_size, int(st.st_mtime),
+                                  self.entities.file_size, self.entities.CRC)
+
+    def attachment_files(self):
+        return self.files
+
+# for messages: where entities.xml is being read from
+def source_name(source):
+    if isinstance(source, str):
+        return '"%s" from current directory' % source
+    return '"%s" in "%s"' % (source.name, exportZip.filename)
+
+# ------------ load entities.xml ------------
+
+report_empty_pages = False
+
+def report_pages_without_content():
+    if report_empty_pages:
+        pages_without_content = [pages[x].title_or_id() for x in pages if pages[x].bodyId=='0']
+        if (len(pages_without_content)):
+            print('The following pages have no content: ', pages_without_content)
+
+# Every class of <object> in entities.xml that we use, and how to add it
+handleObject = {
+    'ConfluenceUserImpl': addUser,
+    'Attachment': addAttachment,
+    'Page': addPage,
+    'BlogPost': addBlogPost,
+    'BodyContent': addBodyContent,
+    }
+
+# class -> [objects handled, seconds spent in the handler]
+objectTimes = {}
+
+# route each object to the handler for its class, in a single pass;
+# if there is a BodyStore, remember the metadata objects in it too
+def dispatch_objects(objs, store=None):
+    for obj in objs:
+        cls = obj.get('class')
+        if cls not in handleObject:
+            continue
+        if store is not None and cls != 'BodyContent':
+            store.add_object(obj)
+        start = time.perf_counter()
+        handleObject[cls](obj)
+        elapsed = time.perf_counter() - start
+        if cls in objectTimes:
+            objectTimes[cls][0] += 1
+            objectTimes[cls][1] += elapsed
+        else:
+            objectTimes[cls] = [1, elapsed]
+
+def report_object_times():
+    for cls, (count, elapsed) in sorted(objectTimes.items(), key=lambda x: -x[1][1]):
+        print('  %-20s %8d objects %9.2fs' % (cls, count, elapsed))
+
+def finish_loading():
+    with runReport.stage('attachment index'):
+        resolve_attachments()
+    report_users()
+    report_pages_without_content()
+    report_object_times()
+
+def load_tree(filename, store=None):
+    print('Loading %s... ' % source_name(filename), end='')
+
+    tree=ET.parse(filename)
+    root=tree.getroot()
+
+    print('Done.')
+
+    if root.tag != 'hibernate-generic':
+        print('not a Confluence export')
+        sys.exit(1)
+
+    print ('Confluence export recognised')
+
+    print('Processing users, attachments, pages, blog posts and content... ', end='')
+    addBlogRoot()
+    dispatch_objects(root, store)
+    print('Done.')
+    finish_loading()
+
+# Yield each top-level <object> as soon as it has been parsed,
+# and drop it from the tree once the caller is done with it, so
+# that only one object is held in memory at a time.
+def iter_objects(filename):
+    context = ET.iterparse(filename, events=('start', 'end'))
+    event, root = next(context)
+    if root.tag != 'hibernate-generic':
+        print('not a Confluence export')
+        sys.exit(1)
+    print ('Confluence export recognised')
+    depth = 0
+    for event, elem in context:
+        if event == 'start':
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 0:
+            if elem.tag == 'object':
+                yield elem
+            root.clear()
+
+def load_stream(filename, store):
+    print('Streaming %s...' % source_name(filename))
+    addBlogRoot()
+    dispatch_objects(iter_objects(filename), store)
+    print('Done.')
+    finish_loading()
+
+# reload the metadata objects kept by a previous run; the bodies
+# are read from the store as they are needed
+def load_store(store):
+    print('Loading export from "%s"... ' % store.filename, end='')
+    addBlogRoot()
+    dispatch_objects(store.objects())
+    print('Done.')
+    finish_loading()
+
+
+# ------------ hierarchy ------------
+
+# The DokuWiki namespace the export goes in, e.g. 'oldwiki' or 'archive:confluence'
+wikiNamespace = 'oldwiki'
 
 # Make a pass to find full 'pathnames' for files, and to create child lists
-print('Creating page and attachment hierarchy ...')
-for x, p in list(pageNames.items()):
-    p.pathname = build_path(p)
-    p.path = p.pathname.replace('/', ':').replace('pages:current', ':oldwiki')
-    p.path = p.path.replace('pages:deleted:', 'oldwiki:deleted:')
-    #print(p.tag, p.pathname, p.title)
-    if p.parent in pages and p.status == "current":
-        pages[p.parent].children.append(p)
-    for attachment in p.attaches:
-        attachment.page = p
-        attachment.filename = p.pathname.replace('pages/current', 'media/oldwiki').replace('pages/deleted', 'media/oldwiki/deleted') + \
-      '/' +  page_name_to_filename(attachment.title)
-    if p.id in outDated:
-        del(pageNames[x])
-
-
-print ('Processing and exporting into markdown...')
-for x in pageNames:
-    p = pageNames[x]
-    count+=1
-    if (count % percent == 0):
-        print ('%s pages exported (%s%%)' % (count, round(count*100/totalcount)))
-    
-    # skip if no content
-    if p.bodyId == '0': continue
-    # skip if not latest version
-    if not p.is_latest(): continue
-    # get the path and content
-    pathname = p.pathname
-    filename = pathname + '.txt'
-    converted_confl = convert(PageContent[p.bodyId], p)
-    # print ('\n' + converted_confl + '\n')
-    markdown = md(converted_confl)
+def build_hierarchy():
+    print('Creating page and attachment hierarchy ...')
+    mediaDir = 'media/' + wikiNamespace.replace(':', '/')
+    for x, p in list(pageNames.items()):
+        p.pathname = build_path(p)
+        p.path = p.pathname.replace('/', ':').replace('pages:current', ':' + wikiNamespace)
+        p.path = p.path.replace('pages:deleted:', wikiNamespace + ':deleted:')
+        #print(p.tag, p.pathname, p.title)
+        if p.parent in pages and p.status == "current":
+            pages[p.parent].children.append(p)
+        for attachment in p.attaches:
+            attachment.page = p
+            attachment.filename = p.pathname.replace('pages/current', mediaDir).replace('pages/deleted', mediaDir + '/deleted') + \
+          '/' +  page_name_to_filename(attachment.title)
+        if p.id in outDated:
+            del(pageNames[x])
+    if hierarchy.missing_parents or hierarchy.cycles:
+        print('%s missing parent pages, %s parent cycles; those pages are placed at the top level' % (
+            len(hierarchy.missing_parents), len(hierarchy.cycles)))
+
+
+# ------------ link graph ------------
+
+# References in the storage format, as Confluence writes them:
+#   <ri:page ri:content-title="T" />
+#   <ri:attachment ri:filename="F"><ri:content-entity ri:content-id="N" /></ri:attachment>
+# Matches CDATA sections too, so the markup in them, e.g. in code
+# macros, is passed over as text
+storageRef = re.compile(r'<!\[CDATA\[.*?\]\]>|<(/?)ri:(page|attachment|content-entity)\b([^>]*?)(/?)>', re.S)
+storageAttr = re.compile(r'([\w:-]+)="([^"]*)"')
+
+# Yields ('page', title) and ('attachment', filename, content id or None)
+# for each reference in a page body, in order
+def references(body):
+    attachment = None
+    for m in storageRef.finditer(body):
+        close, kind, attrs, empty = m.groups()
+        if kind is None:
+            continue
+        if close:
+            if kind == 'attachment' and attachment:
+                yield attachment
+                attachment = None
+            continue
+        attrs = dict((k, html.unescape(v)) for k, v in storageAttr.findall(attrs))
+        if kind == 'attachment':
+            attachment = ('attachment', attrs.get('ri:filename', ''), None)
+            if empty:
+                yield attachment
+                attachment = None
+        elif attachment:
+            # an attachment of another page
+            if kind == 'content-entity':
+                attachment = attachment[:2] + (attrs.get('ri:content-id'),)
+        elif kind == 'page' and 'ri:content-title' in attrs:
+            yield ('page', attrs['ri:content-title'])
+
+class LinkGraph:
+    """
+    Every page's links to other pages and to attachments, put together
+    from the references found as the bodies were loaded, before any page
+    is converted. Gives the markup
+    for each title linked to, what links to each page, the links that
+    lead nowhere, and which pages a rename would change.
+    """
+    def __init__(self):
+        # page id -> titles it links to, once each, in order
+        self.links = {}
+        # title -> ids of the pages linking to it
+        self.backlinks = {}
+        # title -> DokuWiki link, for every title linked to
+        self.markup = {}
+        # (page id, filename) of attachments not found where they should be
+        self.missing_attachments = []
+
+    def build(self):
+        for p in pageNames.values():
+            if p.bodyId != '0' and p.is_latest():
+                self.add_page(p)
+        for title in self.backlinks:
+            if title in pageNames:
+                self.markup[title] = make_internal_link_p(pageNames[title], None)
+            else:
+                self.markup[title] = make_internal_link(title, None)
+
+    def add_page(self, page: Page):
+        refs = PageReferences.get(page.bodyId) if PageReferences is not None else None
+        if refs is None:
+            # bodies in memory, or a body store from before the
+            # references were kept
+            refs = references(PageContent[page.bodyId])
+        links = {}
+        for ref in refs:
+            if ref[0] == 'page':
+                links[ref[1]] = True
+                continue
+            # as rewrite_attachment() finds it
+            owner = pages.get(ref[2], page)
+            if ref[1] not in owner.attachByName:
+                self.missing_attachments.append((page.id, ref[1]))
+        self.links[page.id] = list(links)
+        for title in links:
+            self.backlinks.setdefault(title, []).append(page.id)
+
+    def dangling(self):
+        return dict((t, ids) for t, ids in self.backlinks.items() if t not in pageNames)
+
+    # The pages whose output changes if a page is renamed or moved: the
+    # pages below it, whose paths change, its parent, which lists it,
+    # and every page linking to any of them
+    def affected_by(self, page: Page):
+        affected = {}
+        if page.parent in pages and page.status == 'current':
+            affected[page.parent] = True
+        for p, depth in hierarchy.walk([page]):
+            affected[p.id] = True
+            for id in self.backlinks.get(p.title, ()):
+                affected[id] = True
+        return [pages[id] for id in affected if id in pages]
+
+    def report(self):
+        def names(ids):
+            return [pages[id].pathname for id in ids]
+        linked = set(self.backlinks)
+        return {
+            'backlinks': dict((pageNames[t].pathname, names(ids))
+                              for t, ids in sorted(self.backlinks.items()) if t in pageNames),
+            'dangling_links': dict((t, names(ids)) for t, ids in sorted(self.dangling().items())),
+            'missing_attachments': [{'page': pages[id].pathname, 'filename': f}
+                                    for id, f in self.missing_attachments],
+            'unlinked_pages': sorted(pages[id].pathname for id in self.links
+                                     if pages[id].title not in linked),
+        }
+
+linkGraph = LinkGraph()
+
+# where the link graph's reports go
+link_report_file = 'link-report.json'
+
+def build_link_graph(filename):
+    linkGraph.build()
+    report = linkGraph.report()
+    with open(filename + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=1)
+    os.replace(filename + '.tmp', filename)
+    links = sum(len(l) for l in linkGraph.links.values())
+    dangling = linkGraph.dangling()
+    print('%s links between %s pages; %s links to %s pages not in the export, '
+          '%s attachments not found; see %s' % (
+              links, len(linkGraph.links), sum(len(ids) for ids in dangling.values()),
+              len(dangling), len(linkGraph.missing_attachments), filename))
+    runReport.sections['links'] = {
+        'links': links, 'dangling_links': sum(len(ids) for ids in dangling.values()),
+        'missing_pages': len(dangling), 'missing_attachments': len(linkGraph.missing_attachments),
+        'unlinked_pages': len(report['unlinked_pages']),
+    }
+
+
+# ------------ page selection ------------
+
+class Selection:
+    """
+    Which pages to export: the subtrees under some root pages, or every
+    page; only those with some statuses; with or without blog posts.
+    With links, the pages the selected ones link to are exported too,
+    so that their links lead somewhere.
+    """
+    def __init__(self, roots=(), statuses=None, blog_posts=True, links=False):
+        self.roots = [find_page(r) for r in roots]
+        self.statuses = statuses
+        self.blog_posts = blog_posts
+        self.links = links
+
+    def is_partial(self):
+        return bool(self.roots) or self.statuses is not None or not self.blog_posts
+
+    def wants(self, page: Page):
+        if self.statuses is not None and page.status not in self.statuses:
+            return False
+        return self.blog_posts or not page.is_blog
+
+    def walk(self):
+        for p, depth in hierarchy.walk(self.roots or None):
+            if self.wants(p):
+                yield p, depth
+
+# A page by id or title; an old version's id gives its latest version
+def find_page(spec):
+    page = pages.get(spec) or pageNames.get(spec)
+    if page is None or page.title not in pageNames:
+        raise KeyError('No page with id or title "%s"' % spec)
+    return pageNames[page.title]
+
+
+# ------------ export ------------
+
+class ExportedPage:
+    """
+    A converted page, with what it depended on
+    """
+    def __init__(self, page, markdown):
+        self.id = page.id
+        self.filename = page.pathname + '.txt'
+        self.markdown = markdown
+        # (page id, attachment id, media filename) files to materialize
+        self.media = pageState.media
+        # titles of the pages this one links to
+        self.linked_titles = pageState.linked_titles
+        self.title = page.title
+        self.macros = pageState.macros
+        self.unhandled_macros = pageState.unhandled_macros
+        self.macro_times = pageState.macro_times
+        self.warnings = pageState.warnings
+        # fragment cache (hits, misses)
+        self.fragments = (0, 0)
+        # (words, metadata) for the search index
+        self.index = None
+        # (wall, cpu) seconds
+        self.convert_time = (0, 0)
+        self.render_time = (0, 0)
+
+# Convert a page to markdown. Only reads the global state, so it can
+# run in a worker process.
+def export_page(pageid):
+    global pageState
+    p = pages[pageid]
+    pageState = PageState()
+    pageFragments.clear()
+    pagePlaceholders.clear()
+    cached = (fragmentCache.hits, fragmentCache.misses) if fragmentCache else (0, 0)
+    start = (time.perf_counter(), time.process_time())
+    if renderEngine == 'native':
+        converted_confl = rewrite(PageContent[p.bodyId], p)
+        converted = (time.perf_counter(), time.process_time())
+        markdown = renderer.render(converted_confl)
+    else:
+        converted_confl = convert(PageContent[p.bodyId], p)
+        # print ('\n' + converted_confl + '\n')
+        converted = (time.perf_counter(), time.process_time())
+        markdown = md(converted_confl)
     # print ('\n--------------------\n\n\n' + markdown + '\n')
+    end = (time.perf_counter(), time.process_time())
+    exported = ExportedPage(p, markdown)
+    pageFragments.clear()
+    pagePlaceholders.clear()
+    if fragmentCache:
+        exported.fragments = (fragmentCache.hits - cached[0], fragmentCache.misses - cached[1])
+    if searchIndex is not None:
+        exported.index = index_page(markdown)
+    exported.convert_time = (converted[0] - start[0], converted[1] - start[1])
+    exported.render_time = (end[0] - converted[0], end[1] - converted[1])
+    return exported
+
+# Where the files of the export go: by default pages/ and media/ in the
+# current directory, to be copied into DokuWiki's data/ directory by
+# hand; with --dokuwiki-data, straight into that data/ directory
+dataDir = None
+
+# The name of a file of the export within a DokuWiki data/ directory:
+# pages/current/a/b.txt -> pages/<namespace>/a/b.txt, and other
+# statuses under the namespace, e.g. pages/<namespace>/deleted/c.txt.
+# Media files are already named that way.
+def data_dir_name(filename):
+    parts = filename.split('/')
+    if parts[0] == 'pages':
+        if parts[1] == 'current':
+            del parts[1]
+        parts[1:1] = wikiNamespace.split(':')
+    return '/'.join(parts)
+
+# where a file of the export is written
+def output_path(filename):
+    if dataDir is None:
+        return filename
+    return os.path.join(dataDir, data_dir_name(filename))
+
+# the directory all the exported pages are under
+def pages_root():
+    if dataDir is None:
+        return 'pages'
+    return os.path.join(dataDir, 'pages', *wikiNamespace.split(':'))
+
+class OutputWriter:
+    """
+    Writes exported pages, each to a temporary file that is then
+    renamed over the page, so a page is never seen half written. Makes
+    each directory once. With threaded=True pages are queued and
+    written by a background thread while conversion goes on.
+    """
+    def __init__(self, threaded=False, debug_copy=None):
+        self.made_dirs = set()
+        # also write every page here, to see the last one written
+        self.debug_copy = debug_copy
+        self.error = None
+        self.queue = None
+        self.thread = None
+        if threaded:
+            self.queue = queue.Queue(256)
+            self.thread = threading.Thread(target=self.drain, daemon=True)
+            self.thread.start()
+
+    # markdown may be bytes, for files that are not pages; mtime, if
+    # given, is the time the file is to be dated. done, if given, is
+    # called once the file is written, from the writer thread if there
+    # is one, and not if writing it fails.
+    def write(self, filename, markdown, mtime=None, done=None):
+        if self.queue is None:
+            self.write_file(filename, markdown, mtime)
+            if done:
+                done()
+            return
+        if self.error:
+            raise self.error
+        self.queue.put((filename, markdown, mtime, done))
+
+    def make_dir(self, dir):
+        if dir not in self.made_dirs:
+            os.makedirs(dir, exist_ok=True)
+            self.made_dirs.add(dir)
+
+    def write_file(self, filename, markdown, mtime=None):
+        filename = output_path(filename)
+        dir = os.path.dirname(filename)
+        self.make_dir(dir)
+        tmp = os.path.join(dir, '.%s.tmp' % os.path.basename(filename))
+        if isinstance(markdown, bytes):
+            with open(tmp, 'wb') as f:
+                f.write(markdown)
+        else:
+            with open(tmp, 'w', encoding="utf-8") as f:
+                f.write(markdown)
+            self.write_debug_copy(markdown)
+        if mtime is not None:
+            os.utime(tmp, (mtime, mtime))
+        os.replace(tmp, filename)
+
+    def write_debug_copy(self, markdown):
+        if self.debug_copy:
+            with open(self.debug_copy, 'w', encoding="utf-8") as f:
+                f.write(markdown)
+
+    # Put a copy of the attachment file src in the export as filename.
+    # Returns how, or 'skipped' if it is already there. Called once
+    # the pages are written, so never alongside the writer thread.
+    def add_media(self, src, filename):
+        filename = output_path(filename)
+        self.make_dir(os.path.dirname(filename))
+        if os.path.lexists(filename):
+            return 'skipped'
+        if isinstance(src, ZipMember):
+            src.extract_to(filename)
+            return 'extracted'
+        return place_file(src, filename)
+
+    # Put filename in the export as another name for existing, a file
+    # already added with the same content
+    def add_duplicate(self, existing, filename):
+        filename = output_path(filename)
+        self.make_dir(os.path.dirname(filename))
+        if os.path.lexists(filename):
+            return 'skipped'
+        return place_file(output_path(existing), filename)
+
+    def drain(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                # after a failure, keep taking pages so write() never blocks
+                if self.error is None:
+                    filename, markdown, mtime, done = item
+                    try:
+                        self.write_file(filename, markdown, mtime)
+                        if done:
+                            done()
+                    except Exception as e:
+                        self.error = e
+            finally:
+                self.queue.task_done()
+
+    # wait for queued pages to be written
+    def flush(self):
+        if self.queue is not None:
+            self.queue.join()
+        if self.error:
+            raise self.error
+
+    def close(self):
+        self.flush()
+        if self.thread:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+# compression for tar file name endings
+tarCompression = {'.tar': '', '.tar.gz': 'gz', '.tgz': 'gz', '.tar.bz2': 'bz2', '.tar.xz': 'xz'}
+
+class TarWriter(OutputWriter):
+    """
+    Writes the export as one tar archive, streamed sequentially, laid
+    out as a DokuWiki data/ directory. Compressed as its name says:
+    .tar.zst, .tar.gz, .tar.bz2, .tar.xz, or not for .tar.
+    """
+    def __init__(self, filename, threaded=False, debug_copy=None):
+        self.filename = filename
+        self.finish = None
+        if filename.endswith(('.tar.zst', '.tzst')):
+            if zstandard is not None:
+                stream = zstandard.ZstdCompressor().stream_writer(open(filename, 'wb'))
+                self.finish = stream.close
+            elif shutil.which('zstd'):
+                zstd = subprocess.Popen(['zstd', '-q', '-f', '-o', filename], stdin=subprocess.PIPE)
+                stream = zstd.stdin
+                def finish():
+                    zstd.stdin.close()
+                    if zstd.wait() != 0:
+                        raise OSError('zstd failed writing %s' % filename)
+                self.finish = finish
+            else:
+                print('Writing %s needs the zstandard module or the zstd command' % filename)
+                sys.exit(1)
+            self.archive = tarfile.open(fileobj=stream, mode='w|')
+        else:
+            for ending, compression in tarCompression.items():
+                if filename.endswith(ending):
+                    break
+            else:
+                print('%s: not a .tar, .tar.gz, .tar.bz2, .tar.xz or .tar.zst file name' % filename)
+                sys.exit(1)
+            self.archive = tarfile.open(filename, 'w|' + compression)
+        self.mtime = time.time()
+        OutputWriter.__init__(self, threaded, debug_copy)
+
+    def write_file(self, filename, markdown, mtime=None):
+        if isinstance(markdown, bytes):
+            data = markdown
+        else:
+            data = markdown.encode('utf-8')
+            self.write_debug_copy(markdown)
+        info = tarfile.TarInfo(data_dir_name(filename))
+        info.size = len(data)
+        info.mtime = self.mtime if mtime is None else mtime
+        info.mode = 0o644
+        self.archive.addfile(info, io.BytesIO(data))
+
+    def add_media(self, src, filename):
+        if isinstance(src, ZipMember):
+            info = tarfile.TarInfo(data_dir_name(filename))
+            info.size = src.size
+            info.mtime = time.mktime(src.info.date_time + (0, 0, -1))
+            info.mode = 0o644
+            with src.open() as f:
+                self.archive.addfile(info, f)
+        else:
+            self.archive.add(src, data_dir_name(filename), recursive=False)
+        return 'archived'
+
+    # as a hard link to the earlier member
+    def add_duplicate(self, existing, filename):
+        info = tarfile.TarInfo(data_dir_name(filename))
+        info.type = tarfile.LNKTYPE
+        info.linkname = data_dir_name(existing)
+        info.mtime = self.mtime
+        info.mode = 0o644
+        self.archive.addfile(info)
+        return 'linked'
+
+    def close(self):
+        OutputWriter.close(self)
+        self.archive.close()
+        if self.finish:
+            self.finish()
+
+# With --keep-going, a page that fails to convert is reported instead
+# of stopping the run
+class PageError:
+    def __init__(self, page, error):
+        self.id = page.id
+        self.title = page.title
+        self.filename = page.pathname + '.txt'
+        self.error = '%s: %s' % (type(error).__name__, error)
+        self.traceback = traceback.format_exc()
+
+def try_export_page(pageid):
+    try:
+        return export_page(pageid)
+    except Exception as e:
+        return PageError(pages[pageid], e)
 
-    # markdown = "meow"
-    # print('%s --> %s' % (p.title_or_id(), filename))
+# a forked worker must not share the parent's SQLite connection
+def init_worker():
+    if isinstance(PageContent, BodyStore):
+        PageContent.reopen()
 
-    # write the markdown to file
-    os.makedirs(os.path.dirname(filename), exist_ok=True)
+# ------------ incremental export ------------
 
-    f = open(filename, 'w', encoding="utf-8")
-    f.write(markdown)
-    f.close()
+# Kept next to the output: for each page id, what its last export
+# was made from, so later runs can skip pages that have not changed
+manifest_file = 'export-manifest.json'
 
-    f = open("most_recent_page.md", 'w', encoding="utf-8")
-    f.write(markdown)
-    f.close()
+def load_manifest():
+    try:
+        with open(manifest_file, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+def save_manifest(manifest):
+    with open(manifest_file + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+def body_hash(page):
+    return hashlib.sha1(PageContent[page.bodyId].encode('utf-8')).hexdigest()
+
+def link_target(title):
+    if title in pageNames:
+        return pageNames[title].path
+    return None
 
-    # input('\n\nPress Enter to do the next one...\n\n\n')
+# everything a page's output depends on, except its outgoing links,
+# which are only known once it has been converted
+def manifest_entry(page, hash):
+    return {
+        'version': page.version,
+        'hash': hash,
+        'title': page.title,
+        'pathname': page.pathname,
+        'namespace': wikiNamespace,
+        'attachments': [a.id for a in page.attaches],
+        'children': [[c.path, c.title] for c in page.children],
+        'links': {},
+    }
 
-print('Done.')
+def is_unchanged(entry, old):
+    if old is None or not os.path.exists(output_path(entry['pathname'] + '.txt')):
+        return False
+    for key in ('version', 'hash', 'title', 'pathname', 'namespace', 'attachments', 'children'):
+        if entry[key] != old.get(key):
+            return False
+    return all(link_target(t) == path for t, path in old['links'].items())
+
+# remove the output of pages that have gone, or moved elsewhere
+def remove_stale_pages(old_manifest, manifest):
+    current = set(e['pathname'] for e in manifest.values())
+    top = pages_root()
+    # deepest first, so emptied directories can be removed as we go
+    for old in sorted(old_manifest.values(), key=lambda e: -e['pathname'].count('/')):
+        if old['pathname'] not in current:
+            filename = output_path(old['pathname'] + '.txt')
+            try:
+                os.remove(filename)
+            except OSError:
+                continue
+            # but leave the directories above the export alone
+            dir = os.path.dirname(filename)
+            while dir.startswith(top + '/'):
+                try:
+                    os.rmdir(dir)
+                except OSError:
+                    break
+                dir = os.path.dirname(dir)
+
+
+# ------------ checkpoint ------------
+
+# With --checkpoint FILE, a run that stops part way through can be
+# started again and carry on where it stopped. FILE keeps the loaded
+# export: the users, attachments and page hierarchy, with the page
+# bodies in a BodyStore beside it. FILE.journal gets a line for each
+# page written. Both are removed once a run has exported every page.
+class Checkpoint:
+    def __init__(self, filename):
+        self.filename = filename
+        self.bodies_file = filename + '.bodies'
+        self.journal_file = filename + '.journal'
+        self.journal = None
+
+    # what the loaded state depends on
+    def key(self, source):
+        return [source, wikiNamespace]
+
+    def save_index(self, source):
+        state = {
+            'key': self.key(source),
+            'bodies': PageContent.filename,
+            'users': users, 'attachments': attachments, 'pages': pages,
+            'pageNames': pageNames, 'hiversions': hiversions, 'outDated': outDated,
+            'hierarchy': hierarchy,
+        }
+        with open(self.filename + '.tmp', 'wb') as f:
+            pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(self.filename + '.tmp', self.filename)
+        # a journal from before is of another load
+        if os.path.exists(self.journal_file):
+            os.remove(self.journal_file)
+
+    # Returns whether the state was loaded from the checkpoint
+    def load_index(self, source):
+        global PageContent, PageReferences, hierarchy
+        try:
+            with open(self.filename, 'rb') as f:
+                state = pickle.load(f)
+        except FileNotFoundError:
+            return False
+        except Exception as e:
+            print('Cannot read checkpoint "%s" (%s); starting over' % (self.filename, e))
+            return False
+        if source is None or state['key'] != self.key(source):
+            print('Checkpoint "%s" is of another export or namespace; starting over' % self.filename)
+            return False
+        store = BodyStore(state['bodies'])
+        if store.source() != source:
+            print('Page bodies in "%s" are out of date; starting over' % state['bodies'])
+            return False
+        for name in ('users', 'attachments', 'pages', 'pageNames', 'hiversions', 'outDated'):
+            globals()[name].clear()
+            globals()[name].update(state[name])
+        hierarchy = state['hierarchy']
+        PageContent = store
+        PageReferences = store.refs
+        print('Resuming from checkpoint "%s"' % self.filename)
+        return True
+
+    # page id -> {'entry': manifest entry, 'media': [...]}, for the
+    # pages written before the run stopped
+    def completed(self):
+        done = {}
+        try:
+            with open(self.journal_file, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # the line being written when the run stopped
+                        break
+                    done[record['id']] = record
+        except FileNotFoundError:
+            pass
+        return done
+
+    def record(self, exported, entry):
+        if self.journal is None:
+            self.journal = open(self.journal_file, 'a', encoding='utf-8')
+        self.journal.write(json.dumps({'id': exported.id, 'entry': entry, 'media': exported.media}) + '\n')
+        self.journal.flush()
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def remove(self):
+        self.close()
+        for filename in (self.filename, self.journal_file, self.bodies_file):
+            if os.path.exists(filename):
+                os.remove(filename)
+
+
+# ------------ page history ------------
+
+# With --history, every version of an exported page goes in DokuWiki's
+# attic, as attic/<namespace>/.../page.<timestamp>.txt.gz, and is listed
+# in meta/<namespace>/.../page.changes, oldest first. The page file is
+# dated as its latest version, so DokuWiki sees no external edit.
+
+# DokuWiki id of a page file: pages/current/a/b.txt -> <namespace>:a:b
+def page_id(filename):
+    return data_dir_name(filename)[len('pages/'):-len('.txt')].replace('/', ':')
+
+# the file in meta/ DokuWiki keeps something about a page in, e.g. .changes
+def meta_file(filename, ending):
+    return data_dir_name(filename).replace('pages/', 'meta/', 1)[:-len('.txt')] + ending
+
+# Confluence's dates have no time zone; they are taken as UTC
+def parse_date(date):
+    return calendar.timegm(time.strptime(date[:19], '%Y-%m-%d %H:%M:%S'))
+
+# (timestamp, Page) for each dated version of a page that has a body,
+# oldest first. DokuWiki keeps revisions by the second, so versions made
+# in the same second are spread out a second apart.
+def page_versions(page: Page):
+    versions = [pages[h] for h in page.history if h in pages] + [page]
+    versions = sorted((v for v in versions if v.modified and v.bodyId != '0'), key=lambda v: v.version)
+    dated = []
+    last = 0
+    for v in versions:
+        last = max(parse_date(v.modified), last + 1)
+        dated.append((last, v))
+    return dated
+
+class PageHistory:
+    """
+    A page's versions, rendered and compressed for the attic, and its
+    changelog
+    """
+    def __init__(self, page):
+        self.id = page.id
+        self.title = page.title
+        self.filename = page.pathname + '.txt'
+        # (attic filename, timestamp, gzipped page)
+        self.attic = []
+        self.changes = ''
+        # about any of the versions
+        self.warnings = []
+
+# Render every version of a page, one at a time, in the current page's
+# place. Only reads the global state, so it can run in a worker process.
+def export_history(pageid):
+    global pageState
+    p = pages[pageid]
+    pageState = PageState()
+    history = PageHistory(p)
+    id = page_id(history.filename)
+    attic = data_dir_name(history.filename).replace('pages/', 'attic/', 1)[:-len('.txt')]
+    lines = []
+    size = 0
+    last = None
+    for n, (timestamp, v) in enumerate(page_versions(p)):
+        body = PageContent[v.bodyId]
+        # a version may only have changed the page's title or place
+        if body != last:
+            if renderEngine == 'native':
+                markdown = renderer.render(rewrite(body, p))
+            else:
+                markdown = md(convert(body, p))
+            data = markdown.encode('utf-8')
+            last = body
+        history.attic.append(('%s.%d.txt.gz' % (attic, timestamp), timestamp,
+                              gzip.compress(data, 6, mtime=timestamp)))
+        user = get_user(v.modifier)
+        comment = re.sub(r'\s+', ' ', v.comment).strip()
+        lines.append('\t'.join([str(timestamp), '127.0.0.1', 'E' if n else 'C', id,
+                                user.userid if user else '', comment, '', str(len(data) - size)]))
+        size = len(data)
+    history.warnings = pageState.warnings
+    pageState = PageState()
+    history.changes = ''.join(line + '\n' for line in lines)
+    return history
+
+def try_export_history(pageid):
+    try:
+        return export_history(pageid)
+    except Exception as e:
+        return PageError(pages[pageid], e)
+
+# Write the history of the pages converted this run, and of the others
+# that have no changelog yet, e.g. from before --history was used.
+# Pages go to the workers a few at a time, so only those are in memory.
+def export_histories(converted, others, jobs, writer, keep_going):
+    def changes_file(pageid):
+        return meta_file(pages[pageid].pathname + '.txt', '.changes')
+    todo = list(converted)
+    if not isinstance(writer, TarWriter):
+        todo.extend(id for id in others if not os.path.exists(output_path(changes_file(id))))
+    work = try_export_history if keep_going else export_history
+    executor = None
+    if jobs > 1:
+        executor = ProcessPoolExecutor(jobs, mp_context=multiprocessing.get_context('fork'),
+                                       initializer=init_worker)
+    print('Exporting the history of %s pages...' % len(todo))
+    errors = []
+    versions = 0
+    compressed = 0
+    window = max(jobs, 1) * 4
+    for start in range(0, len(todo), window):
+        batch = todo[start:start + window]
+        results = executor.map(work, batch) if executor else map(work, batch)
+        for history in results:
+            if isinstance(history, PageError):
+                print('History of page %s failed: %s' % (history.title, history.error))
+                errors.append(history)
+                continue
+            for warning in history.warnings:
+                print(warning)
+            for filename, timestamp, data in history.attic:
+                writer.write(filename, data, timestamp)
+                compressed += len(data)
+            # last, so that a page with a changelog has its attic written
+            writer.write(changes_file(history.id), history.changes.encode('utf-8'))
+            versions += len(history.attic)
+    if executor:
+        executor.shutdown()
+    writer.flush()
+    print('%s versions of %s pages written to the attic, %.1f MiB compressed' % (
+        versions, len(todo) - len(errors), compressed / 1048576))
+    return {'pages': len(todo) - len(errors), 'versions': versions, 'attic_bytes': compressed}, errors
+
+
+# ------------ search index ------------
+
+# DokuWiki's search index, data/index/, made from the exported pages as
+# they are converted, so the wiki need not index them all after import.
+# Words are found as DokuWiki's indexer (Indexer::tokenizer) finds them:
+# CJK characters each a word of their own, punctuation other than
+# . _ - : and * turned into spaces, split at spaces, lower-cased, leaving
+# out stop words and words shorter than two bytes that are not numbers.
+
+# with --search-index
+searchIndex = None
+
+# DokuWiki's INDEXER_VERSION, which it keeps in each page's .indexed
+indexVersion = '8'
+
+# inc/lang/en/stopwords.txt
+indexStopwords = set(['about', 'are', 'as', 'an', 'and', 'you', 'your', 'them', 'their', 'com',
+                      'for', 'from', 'into', 'if', 'in', 'is', 'it', 'how', 'of', 'on', 'or',
+                      'that', 'the', 'this', 'to', 'was', 'what', 'when', 'where', 'who', 'will',
+                      'with', 'und', 'www'])
+
+indexAsian = re.compile('([\u0e00-\u0e7f\u2e80-\u3040\u309d-\u30a0\u30fd-\u31ef\u3200-\ud7af'
+                        '\uf900-\ufaff\ufe30-\ufe4f\U00020000-\U0002fa1f])')
+indexPlain = re.compile(r'[^0-9A-Za-z ]')
+indexBlank = str.maketrans({'\r': ' ', '\n': ' ', '\t': ' ', '\xad': None})
+# Clean::stripspecials() with '._-:*' kept; the non-ASCII characters its
+# table has are taken to be those that are not letters or digits
+indexSpecial = re.compile(r'[^\w .\-:*]')
+# link and media markup, which markdown may have escaped
+indexLink = re.compile(r'\[\\?\[([^\]]*)')
+indexMedia = re.compile(r'\{\{([^}]*)')
+markdownEscape = re.compile(r'\\([^0-9A-Za-z\s])')
+indexTarget = re.compile(r'[|#?]')
+
+# a word's length, as DokuWiki counts it: in bytes, but longer for CJK
+# characters, so that they don't all go in w3.idx
+def word_length(word):
+    data = word.encode('utf-8')
+    return len(data) + sum(b - 0xE1 for b in data if 0xE2 <= b <= 0xEF)
+
+# word -> how many times the text has it
+def index_words(text):
+    if indexPlain.search(text):
+        text = indexAsian.sub(r' \1 ', text)
+    text = text.translate(indexBlank)
+    if indexPlain.search(text):
+        text = indexSpecial.sub(' ', text)
+    words = {}
+    for word, count in Counter(text.split(' ')).items():
+        word = word.lower()
+        if (len(word.encode('utf-8')) < 2 and not word.isdigit()) or word in indexStopwords:
+            continue
+        words[word] = words.get(word, 0) + count
+    return words
+
+# the page and media ids a page's links and images refer to; not URLs,
+# interwiki or email links
+def link_ids(pattern, text):
+    ids = []
+    for m in pattern.finditer(text):
+        target = indexTarget.split(markdownEscape.sub(r'\1', m.group(1)), 1)[0].strip()
+        if '://' in target or '>' in target or '@' in target:
+            continue
+        target = target.strip(':').lower()
+        if target and target not in ids:
+            ids.append(target)
+    return ids
+
+# What the index keeps of a page: its words, and the metadata DokuWiki
+# indexes, the pages it links to and the media it uses
+def index_page(text):
+    return index_words(text), {'relation_references': link_ids(indexLink, text),
+                               'relation_media': link_ids(indexMedia, text)}
+
+class MetaIndex:
+    """
+    One of DokuWiki's metadata indexes: the values (<name>_w.idx), the
+    pages having each (<name>_i.idx), and each page's values (<name>_p.idx)
+    """
+    def __init__(self):
+        self.values = []
+        self.ids = {}
+        # value id -> pids
+        self.uses = []
+        # pid -> value ids
+        self.pages = {}
+
+    def add(self, pid, values):
+        self.pages[pid] = []
+        for value in values:
+            vid = self.ids.get(value)
+            if vid is None:
+                vid = self.ids[value] = len(self.values)
+                self.values.append(value)
+                self.uses.append(set())
+            self.uses[vid].add(pid)
+            self.pages[pid].append(vid)
+
+    def remove(self, pid):
+        for vid in self.pages.pop(pid, ()):
+            self.uses[vid].discard(pid)
+
+class SearchIndex:
+    """
+    DokuWiki's search index, built in bulk: page.idx and title.idx, the
+    words of each length in w<len>.idx with the pages using them in
+    i<len>.idx, pageword.idx, lengths.idx, and the metadata indexes
+    named in metadata.idx. An index already in the output is read first
+    so the wiki's other pages stay in it; pages in the export's
+    namespace that are not added again are taken out.
+    """
+    def __init__(self, version=indexVersion):
+        # what each page's .indexed is to say
+        self.version = version
+        self.ids = []
+        self.pids = {}
+        self.titles = []
+        # pid -> [(word length, word id)]
+        self.pagewords = []
+        # word length -> words; word -> word id; word id -> {pid: frequency}
+        self.words = {}
+        self.wids = {}
+        self.uses = {}
+        # name -> MetaIndex
+        self.meta = OrderedDict()
+        # page ids added this run
+        self.added = set()
+
+    def load(self, dir):
+        def read(name):
+            try:
+                with open(os.path.join(dir, name), encoding='utf-8') as f:
+                    return f.read().split('\n')[:-1]
+            except FileNotFoundError:
+                return []
+        if not os.path.isdir(dir):
+            return
+        self.ids = read('page.idx')
+        self.pids = dict((id, pid) for pid, id in enumerate(self.ids))
+        n = len(self.ids)
+        self.titles = (read('title.idx') + [''] * n)[:n]
+        self.pagewords = [[tuple(int(x) for x in w.split('*')) for w in line.split(':') if w]
+                          for line in (read('pageword.idx') + [''] * n)[:n]]
+        for name in os.listdir(dir):
+            m = re.fullmatch(r'w(\d+)\.idx', name)
+            if not m:
+                continue
+            length = int(m.group(1))
+            self.words[length] = read(name)
+            self.wids[length] = dict((w, wid) for wid, w in enumerate(self.words[length]))
+            uses = [counts(line) for line in read('i%d.idx' % length)]
+            self.uses[length] = uses + [{} for _ in range(len(self.words[length]) - len(uses))]
+        for name in read('metadata.idx'):
+            meta = self.meta[name] = MetaIndex()
+            meta.values = read(name + '_w.idx')
+            meta.ids = dict((v, vid) for vid, v in enumerate(meta.values))
+            uses = [set(counts(line)) for line in read(name + '_i.idx')]
+            meta.uses = uses + [set() for _ in range(len(meta.values) - len(uses))]
+            for pid, line in enumerate(read(name + '_p.idx')):
+                if line:
+                    meta.pages[pid] = [int(vid) for vid in line.split(':')]
+
+    def pid(self, id):
+        pid = self.pids.get(id)
+        if pid is None:
+            pid = self.pids[id] = len(self.ids)
+            self.ids.append(id)
+            self.titles.append('')
+            self.pagewords.append([])
+        return pid
+
+    # take a page out, keeping its pid, as DokuWiki does
+    def remove(self, pid):
+        for length, wid in self.pagewords[pid]:
+            self.uses[length][wid].pop(pid, None)
+        self.pagewords[pid] = []
+        self.titles[pid] = ''
+        for meta in self.meta.values():
+            meta.remove(pid)
+
+    # the page written to filename, with words and metadata as
+    # index_page() makes them
+    def add_page(self, filename, title, words, metadata):
+        id = page_id(filename)
+        pid = self.pid(id)
+        self.remove(pid)
+        self.added.add(id)
+        self.titles[pid] = title.replace('\n', ' ')
+        for word, count in words.items():
+            length = word_length(word)
+            if length not in self.words:
+                self.words[length] = []
+                self.wids[length] = {}
+                self.uses[length] = []
+            wid = self.wids[length].get(word)
+            if wid is None:
+                wid = self.wids[length][word] = len(self.words[length])
+                self.words[length].append(word)
+                self.uses[length].append({})
+            self.uses[length][wid][pid] = count
+            self.pagewords[pid].append((length, wid))
+        for name, values in metadata.items():
+            if name not in self.meta:
+                self.meta[name] = MetaIndex()
+            self.meta[name].add(pid, values)
+
+    # (name, content) of each file, as DokuWiki writes them: a line each,
+    # with the newest pid first in each list of pages
+    def files(self):
+        namespace = wikiNamespace + ':'
+        for id, pid in self.pids.items():
+            if id.startswith(namespace) and id not in self.added:
+                self.remove(pid)
+        def lines(items):
+            return ''.join(item + '\n' for item in items)
+        def tuples(uses):
+            return ':'.join('%d*%d' % (pid, uses[pid]) for pid in sorted(uses, reverse=True))
+        yield 'page.idx', lines(self.ids)
+        yield 'title.idx', lines(self.titles)
+        yield 'pageword.idx', lines(':'.join('%d*%d' % w for w in words) for words in self.pagewords)
+        for length in sorted(self.words):
+            yield 'w%d.idx' % length, lines(self.words[length])
+            yield 'i%d.idx' % length, lines(tuples(uses) for uses in self.uses[length])
+        yield 'lengths.idx', lines(str(length) for length in sorted(self.words))
+        yield 'metadata.idx', lines(self.meta)
+        for name, meta in self.meta.items():
+            yield name + '_w.idx', lines(meta.values)
+            yield name + '_i.idx', lines(tuples(dict.fromkeys(uses, 1)) for uses in meta.uses)
+            yield name + '_p.idx', lines(':'.join(str(vid) for vid in meta.pages.get(pid, ()))
+                                         for pid in range(len(self.ids)))
+
+# 'pid*count:...' -> {pid: count}
+def counts(line):
+    found = {}
+    for entry in line.split(':'):
+        if entry:
+            pid, count = entry.split('*')
+            found[int(pid)] = int(count)
+    return found
+
+# Add the exported pages not converted this run, from their files, then
+# write the index, and a .indexed file for every page so DokuWiki does
+# not index it again
+def write_search_index(manifest, writer):
+    for entry in manifest.values():
+        filename = entry['pathname'] + '.txt'
+        if page_id(filename) in searchIndex.added or isinstance(writer, TarWriter):
+            continue
+        try:
+            with open(output_path(filename), encoding='utf-8') as f:
+                text = f.read()
+        except FileNotFoundError:
+            continue
+        searchIndex.add_page(filename, entry['title'], *index_page(text))
+    size = 0
+    for name, data in searchIndex.files():
+        data = data.encode('utf-8')
+        size += len(data)
+        writer.write('index/' + name, data)
+    # DokuWiki indexes a page again unless its .indexed is newer than it
+    mtime = int(time.time()) + 1
+    for entry in manifest.values():
+        writer.write(meta_file(entry['pathname'] + '.txt', '.indexed'), searchIndex.version.encode('utf-8'), mtime)
+    writer.flush()
+    words = sum(len(w) for w in searchIndex.words.values())
+    print('Search index: %s pages, %s words, %.1f MiB' % (len(searchIndex.added), words, size / 1048576))
+    return {'pages': len(searchIndex.added), 'words': words, 'bytes': size}
+
+# ------------ attachment files ------------
+
+# Attachments are found (from the export) in
+#   attachments / PageID / AttachmentID / version
+# Returns (page id, attachment id) -> the file of the highest version
+def scan_attachments(top='attachments'):
+    files = {}
+    try:
+        pagedirs = list(os.scandir(top))
+    except FileNotFoundError:
+        print('No "%s" directory; attachments will be missing' % top)
+        return files
+    for pagedir in pagedirs:
+        if not pagedir.is_dir():
+            continue
+        for attachdir in os.scandir(pagedir.path):
+            if not attachdir.is_dir():
+                continue
+            best = -1
+            for f in os.scandir(attachdir.path):
+                if f.name.isdigit() and int(f.name) > best:
+                    best = int(f.name)
+            if best >= 0:
+                files[(pagedir.name, attachdir.name)] = os.path.join(attachdir.path, str(best))
+    return files
+
+FICLONE = 0x40049409
+
+# Put a copy of src at dst: a hard link if possible, otherwise (e.g.
+# across filesystems) a copy-on-write clone, otherwise a plain copy
+def place_file(src, dst):
+    try:
+        os.link(src, dst)
+        return 'linked'
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+            raise
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return 'reflinked'
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
+    return 'copied'
+
+class HashCache:
+    """
+    Attachment file -> SHA-256 of its content, kept on disk between
+    runs. An entry is only used while the file has the size and
+    modification time it had when it was hashed.
+    """
+    def __init__(self, filename=None):
+        self.filename = filename
+        # file -> [[size, mtime], digest]
+        self.entries = {}
+        self.hits = 0
+        if filename:
+            try:
+                with open(filename, encoding='utf-8') as f:
+                    self.entries = json.load(f)
+            except FileNotFoundError:
+                pass
+
+    def get(self, name, stamp):
+        entry = self.entries.get(name)
+        if entry is not None and entry[0] == stamp:
+            self.hits += 1
+            return entry[1]
+        return None
+
+    def put(self, name, stamp, digest):
+        self.entries[name] = [stamp, digest]
+
+    def save(self):
+        if not self.filename:
+            return
+        with open(self.filename + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f)
+        os.replace(self.filename + '.tmp', self.filename)
+
+# An attachment file's name in the hash cache, and [size, mtime]
+def file_stamp(src):
+    if isinstance(src, ZipMember):
+        return ('%s:%s' % (os.path.abspath(src.archive.filename), src.info.filename),
+                [src.size, list(src.info.date_time)])
+    st = os.stat(src)
+    return os.path.abspath(src), [st.st_size, st.st_mtime_ns]
+
+# SHA-256 of a file's content, read a MiB at a time; None if it can't
+# be read
+def hash_file(src):
+    digest = hashlib.sha256()
+    try:
+        with src.open() if isinstance(src, ZipMember) else open(src, 'rb') as f:
+            while True:
+                chunk = f.read(1 << 20)
+                if not chunk:
+                    break
+                digest.update(chunk)
+    except OSError as e:
+        print('\nCannot hash %s: %s' % (src, e))
+        return None
+    return digest.hexdigest()
+
+# (page id, attachment id) -> (content hash, size) of the attachment
+# files that have the same size as another; the others can't have a
+# duplicate, so are not read. Hashes in jobs threads, which hashlib
+# lets run at once.
+def hash_attachments(files, hashes, jobs=1):
+    stamps = {}
+    by_size = {}
+    for key, src in files.items():
+        stamps[key] = file_stamp(src)
+        by_size.setdefault(stamps[key][1][0], []).append(key)
+    digests = {}
+    todo = []
+    for size, keys in by_size.items():
+        if len(keys) < 2:
+            continue
+        for key in keys:
+            digest = hashes.get(*stamps[key])
+            if digest is None:
+                todo.append(key)
+            else:
+                digests[key] = (digest, size)
+    print('Hashing %s attachment files, %s more from the hash cache... ' % (
+        len(todo), len(digests)), end='')
+    with ThreadPoolExecutor(max(jobs, 1)) as executor:
+        for key, digest in zip(todo, executor.map(hash_file, [files[key] for key in todo])):
+            if digest is not None:
+                digests[key] = (digest, stamps[key][1][0])
+                hashes.put(*stamps[key], digest)
+    hashes.save()
+    print('Done.')
+    return digests
+
+# Create every media file the exported pages refer to, in one batch.
+# With hashes, a HashCache, files with the same content are all made
+# from the first one placed: hard links to it, or in a tar, hard link
+# members.
+def materialize_attachments(media, writer, hashes=None, jobs=1):
+    if exportZip is not None:
+        files = exportZip.attachment_files()
+    else:
+        files = scan_attachments()
+    digests = {}
+    if hashes is not None:
+        digests = hash_attachments(dict((key, files[key]) for key in set(media.values())
+                                        if key in files), hashes, jobs)
+    print('Materializing %s attachment files... ' % len(media), end='')
+    counts = dict.fromkeys(['linked', 'reflinked', 'copied', 'extracted', 'archived',
+                            'skipped', 'missing', 'failed', 'deduplicated', 'bytes_saved'], 0)
+    # content hash -> the first media file with it
+    placed = {}
+    for safe_filename, key in sorted(media.items()):
+        if key not in files:
+            counts['missing'] += 1
+            continue
+        digest, size = digests.get(key, (None, 0))
+        try:
+            if digest in placed:
+                how = writer.add_duplicate(placed[digest], safe_filename)
+                if how in ('linked', 'reflinked'):
+                    counts['deduplicated'] += 1
+                    counts['bytes_saved'] += size
+            else:
+                how = writer.add_media(files[key], safe_filename)
+                # one already there, from an earlier run, may be out of date
+                if digest is not None and how != 'skipped':
+                    placed[digest] = safe_filename
+            counts[how] += 1
+        except OSError as e:
+            print('\nCannot create %s from %s: %s' % (safe_filename, files[key], e))
+            counts['failed'] += 1
+    print('Done.')
+    print('Attachments: %(linked)s linked, %(reflinked)s reflinked, %(copied)s copied, '
+          '%(extracted)s extracted, %(archived)s archived, %(skipped)s already present, '
+          '%(missing)s missing, %(failed)s failed' % counts)
+    if hashes is not None:
+        print('%s attachment files shared with an identical one, %.1f MiB saved' % (
+            counts['deduplicated'], counts['bytes_saved'] / 1048576))
+    return counts
+
+
+# ------------ export ------------
+
+def export_pages(jobs=1, incremental=False, writer=None, selection=None,
+                 checkpoint=None, keep_going=False, history=False, hashes=None):
+    writer = writer or OutputWriter()
+    selection = selection or Selection()
+    partial = selection.is_partial()
+    old_manifest = load_manifest() if incremental or partial else {}
+    # pages written by the run that was stopped
+    resumed = checkpoint.completed() if checkpoint else {}
+    manifest = {}
+    todo = []
+    # media filename -> (page id, attachment id), for all exported pages
+    media = {}
+
+    # add a page to the export, unless it has been already; returns
+    # whether it is to be converted
+    def plan(p):
+        # skip if no content, or not latest version
+        if p.id in manifest or p.bodyId == '0' or not p.is_latest():
+            return False
+        entry = manifest_entry(p, body_hash(p))
+        old = old_manifest.get(p.id)
+        if incremental and is_unchanged(entry, old):
+            manifest[p.id] = old
+            return False
+        done = resumed.get(p.id)
+        if done is not None and is_unchanged(entry, done['entry']):
+            manifest[p.id] = done['entry']
+            for page_id, attach_id, safe_filename in done['media']:
+                media.setdefault(safe_filename, (page_id, attach_id))
+            return False
+        manifest[p.id] = entry
+        return True
+
+    # the pages linked to that are not in the export yet, to convert
+    def link_closure(titles):
+        return [pageNames[t].id for t in titles if t in pageNames and plan(pageNames[t])]
+
+    # export in tree order, parents first
+    with runReport.stage('plan'):
+        for p, depth in selection.walk():
+            if plan(p):
+                todo.append(p.id)
+        selected = len(manifest)
+        if selection.links:
+            # follow the link graph from every selected page, changed or not
+            done = set()
+            while len(done) < len(manifest):
+                for id in [i for i in manifest if i not in done]:
+                    done.add(id)
+                    todo.extend(link_closure(linkGraph.links.get(id) or manifest[id]['links']))
+    runReport.sections['pages'] = {'exported': len(todo), 'unchanged': len(manifest) - len(todo)}
+    if partial:
+        print('%s pages selected' % selected)
+    if resumed:
+        done = sum(1 for id, e in manifest.items() if id in resumed and e is resumed[id]['entry'])
+        runReport.sections['pages']['resumed'] = done
+        print('%s pages already written before the run was stopped' % done)
+    if incremental:
+        print('%s pages unchanged since the last export' % (len(manifest) - len(todo)))
+
+    print ('Processing and exporting into markdown...')
+    executor = None
+    if jobs > 1:
+        # workers are forked after loading, so they share pages, users and
+        # attachments read-only; results come back in order, and all
+        # writing and linking happens here
+        executor = ProcessPoolExecutor(jobs, mp_context=multiprocessing.get_context('fork'),
+                                       initializer=init_worker)
+
+    convert_page = try_export_page if keep_going else export_page
+    errors = []
+    converted = []
+
+    # [wall, cpu] seconds, over all pages
+    spent = {'convert': [0, 0], renderEngine: [0, 0], 'write': [0, 0]}
+    count = 0
+    # with links, each round converts the pages the last one linked to
+    while todo:
+        totalcount = count + len(todo)
+        percent = max(1, int(totalcount/100))
+        if executor:
+            results = executor.map(convert_page, todo, chunksize=8)
+        else:
+            results = map(convert_page, todo)
+        todo = []
+        for exported in results:
+            count += 1
+            if not isinstance(exported, PageError):
+                for warning in exported.warnings:
+                    print(warning)
+            if (count % percent == 0):
+                print ('%s pages exported (%s%%)' % (count, round(count*100/totalcount)))
+            if isinstance(exported, PageError):
+                print('Page %s failed: %s' % (exported.title, exported.error))
+                errors.append(exported)
+                # so that the next run tries it again
+                del manifest[exported.id]
+                continue
+            converted.append(exported.id)
+            # dated as its latest version, as DokuWiki expects with a history
+            mtime = None
+            if history:
+                versions = page_versions(pages[exported.id])
+                mtime = versions[-1][0] if versions else None
+            manifest[exported.id]['links'] = dict((t, link_target(t)) for t in exported.linked_titles)
+            # journalled only once the page is on disk
+            done = None
+            if checkpoint:
+                done = functools.partial(checkpoint.record, exported, manifest[exported.id])
+            start = (time.perf_counter(), time.process_time())
+            writer.write(exported.filename, exported.markdown, mtime, done)
+            spent['write'][0] += time.perf_counter() - start[0]
+            spent['write'][1] += time.process_time() - start[1]
+            for stage, (wall, cpu) in (('convert', exported.convert_time), (renderEngine, exported.render_time)):
+                spent[stage][0] += wall
+                spent[stage][1] += cpu
+            runReport.add_page(exported)
+            for page_id, attach_id, safe_filename in exported.media:
+                media.setdefault(safe_filename, (page_id, attach_id))
+            if exported.index:
+                searchIndex.add_page(exported.filename, exported.title, *exported.index)
+            if selection.links:
+                todo.extend(link_closure(exported.linked_titles))
+    if selection.links:
+        runReport.sections['pages'].update(exported=count, linked=len(manifest) - selected)
+        print('%s linked pages added to the selection' % (len(manifest) - selected))
+    # the pages of this export; those below are only carried over
+    chosen = list(manifest)
+    if partial:
+        # keep what the last run recorded for the pages not selected
+        for id, old in old_manifest.items():
+            if id not in manifest and id in pages and id not in outDated:
+                manifest[id] = old
+
+    if executor:
+        executor.shutdown()
+    start = (time.perf_counter(), time.process_time())
+    writer.flush()
+    spent['write'][0] += time.perf_counter() - start[0]
+    spent['write'][1] += time.process_time() - start[1]
+    rss = max(peak_rss(), peak_rss(resource.RUSAGE_CHILDREN))
+    for stage, (wall, cpu) in spent.items():
+        runReport.add_stage(stage, wall, cpu, rss)
+    if incremental:
+        remove_stale_pages(old_manifest, manifest)
+    save_manifest(manifest)
+    print('Done.')
+
+    if searchIndex is not None:
+        with runReport.stage('search index'):
+            runReport.sections['search_index'] = write_search_index(manifest, writer)
+    if history:
+        exported = set(converted)
+        others = [id for id in chosen if id not in exported]
+        with runReport.stage('history'):
+            runReport.sections['history'], failed = export_histories(
+                converted, others, jobs, writer, keep_going)
+        errors.extend(failed)
+    if errors:
+        runReport.sections['errors'] = [
+            {'id': e.id, 'title': e.title, 'filename': e.filename,
+             'error': e.error, 'traceback': e.traceback} for e in errors]
+        print('%s pages failed to convert; they are listed in the run report' % len(errors))
+
+    with runReport.stage('attachment files'):
+        runReport.sections['attachments'] = materialize_attachments(media, writer, hashes, jobs)
+    writer.close()
+    if checkpoint:
+        if errors:
+            # a rerun converts just the failed pages
+            checkpoint.close()
+        else:
+            checkpoint.remove()
+    return errors
+
+
+# Load the export, look up user names and build the page hierarchy
+def load_export(args, resolver, source, entities):
+    global PageContent, PageReferences
+    lookup = None
+    if resolver:
+        lookup = start_name_lookup(resolver, sorted(set(userMapping.values())))
+    with runReport.stage('load'):
+        if args.body_store or args.stream:
+            PageContent = BodyStore(args.body_store)
+            PageReferences = PageContent.refs
+            store_source = PageContent.source()
+            if store_source is not None and source in (None, store_source):
+                load_store(PageContent)
+            else:
+                PageContent.clear()
+                if args.stream:
+                    load_stream(entities(), PageContent)
+                else:
+                    load_tree(entities(), PageContent)
+                PageContent.finish(source)
+        else:
+            load_tree(entities())
+    if lookup:
+        with runReport.stage('user names'):
+            lookup.join()
+            apply_user_names()
+    with runReport.stage('hierarchy'):
+        build_hierarchy()
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Convert a Confluence space export to DokuWiki pages and media')
+    parser.add_argument('--stream', action='store_true',
+                        help='parse entities.xml incrementally, keeping page bodies on disk '
+                        'instead of holding the whole export in memory')
+    parser.add_argument('--jobs', '-j', type=int, default=1, metavar='N',
+                        help='convert pages in N worker processes')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only convert pages that changed since the run that wrote %s' % manifest_file)
+    parser.add_argument('--body-store', metavar='FILE',
+                        help='keep page bodies in this SQLite file; a later run against '
+                        'the same export loads from it without parsing entities.xml')
+    parser.add_argument('--parser', choices=['html.parser', 'lxml', 'lxml-xml'], default='html.parser',
+                        help='BeautifulSoup parser for page bodies (default: %(default)s)')
+    parser.add_argument('--root', action='append', default=[], metavar='PAGE',
+                        help='only export this page, by id or title, and the pages below it; '
+                        'may be given more than once')
+    parser.add_argument('--status', action='append', metavar='STATUS',
+                        help='only export pages with this status, e.g. current or deleted; '
+                        'may be given more than once (default: any)')
+    parser.add_argument('--no-blog-posts', action='store_true', help='leave blog posts out')
+    parser.add_argument('--with-links', action='store_true',
+                        help='also export the pages that the selected pages link to, and so on')
+    parser.add_argument('--zip', metavar='FILE',
+                        help='read the export straight from the ZIP file Confluence made, '
+                        'instead of from entities.xml and attachments/ in the current directory')
+    parser.add_argument('--engine', choices=['markdownify', 'native'], default='markdownify',
+                        help='render pages with markdownify, or with the native renderer, which '
+                        'skips serializing and reparsing each page (default: %(default)s)')
+    parser.add_argument('--macros', action='append', default=[], metavar='MODULE',
+                        help='add or replace macro handlers with those that a module, by name or .py '
+                        'file, registers in its register_macros(registry); may be given more than once')
+    parser.add_argument('--macro-cache', type=int, default=0, metavar='N',
+                        help='with --engine native, render each distinct macro once, keeping the '
+                        'last N rendered (default: off)')
+    parser.add_argument('--namespace', default='oldwiki',
+                        help='DokuWiki namespace to put the export in, e.g. archive:confluence '
+                        '(default: %(default)s)')
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument('--dokuwiki-data', metavar='DIR',
+                        help="write pages and media straight into this DokuWiki data/ directory")
+    output.add_argument('--tar', metavar='FILE',
+                        help='write pages and media into one archive, laid out as a DokuWiki data/ '
+                        'directory: FILE.tar.zst, .tar.gz, .tar.bz2, .tar.xz or .tar')
+    parser.add_argument('--history', action='store_true',
+                        help="also export every page's older versions, to DokuWiki's attic/ "
+                        'and meta/*.changes')
+    parser.add_argument('--search-index', action='store_true',
+                        help="also write DokuWiki's search index, index/ and meta/*.indexed, so the "
+                        'wiki need not index the pages after import')
+    parser.add_argument('--index-stopwords', metavar='FILE',
+                        help="words to leave out of the search index, one a line, as in DokuWiki's "
+                        'inc/lang/*/stopwords.txt (default: the English ones)')
+    parser.add_argument('--index-version', default=indexVersion, metavar='VERSION',
+                        help="the wiki's indexer version, as its .indexed files have it, with "
+                        'any plugins\' versions (default: %(default)s)')
+    parser.add_argument('--dedup-media', action='store_true',
+                        help='make attachment files with the same content hard links to one file, '
+                        'found by hashing them')
+    parser.add_argument('--hash-cache', default='attachment-hashes.json', metavar='FILE',
+                        help='where the hashes of attachment files are kept between runs, for '
+                        '--dedup-media (default: %(default)s)')
+    parser.add_argument('--link-report', default=link_report_file, metavar='FILE',
+                        help='write backlinks, dangling links, missing attachments and unlinked '
+                        'pages here (default: %(default)s)')
+    parser.add_argument('--affected-by', metavar='PAGE',
+                        help='list the pages whose output would change if PAGE, by id or title, '
+                        'were renamed or moved, and stop')
+    parser.add_argument('--checkpoint', metavar='FILE',
+                        help='keep the loaded export and the pages written so far in FILE, so that '
+                        'if the run stops, running again carries on where it stopped')
+    parser.add_argument('--keep-going', action='store_true',
+                        help='report pages that fail to convert in the run report and carry on, '
+                        'instead of stopping')
+    parser.add_argument('--writer-thread', action='store_true',
+                        help='write pages from a background thread, overlapping output with conversion')
+    parser.add_argument('--debug-copy', metavar='FILE', nargs='?', const='most_recent_page.md',
+                        help='also write each page to FILE as it is exported (default: %(const)s)')
+    parser.add_argument('--report', default=report_file, metavar='FILE',
+                        help='write timings, memory use and macro counts for the run here '
+                        '(default: %(default)s)')
+    parser.add_argument('--ldap-server', default='ldap://ldap.keg.cse.unsw.edu.au',
+                        help='LDAP server to look up user names in (default: %(default)s)')
+    parser.add_argument('--ldap-base', default='ou=Accounts,dc=keg,dc=cse,dc=unsw,dc=edu,dc=au',
+                        help='search base for user names (default: %(default)s)')
+    parser.add_argument('--no-ldap', action='store_true',
+                        help='do not look up user names; use only the name cache')
+    parser.add_argument('--user-names', metavar='FILE',
+                        help='take user names from a JSON {uid: name} or CSV uid,name file '
+                        'instead of LDAP')
+    parser.add_argument('--name-cache', default='user-names-cache.json', metavar='FILE',
+                        help='where looked-up user names are kept between runs (default: %(default)s)')
+    parser.add_argument('--name-cache-ttl', type=float, default=168, metavar='HOURS',
+                        help='look cached names up again after this long (default: %(default)s)')
+    args = parser.parse_args()
+
+    global userNames, soupParser, renderEngine, wikiNamespace, dataDir, exportZip, fragmentCache
+    global searchIndex, indexStopwords
+    soupParser = args.parser
+    renderEngine = args.engine
+    wikiNamespace = args.namespace.strip(':')
+    dataDir = args.dokuwiki_data
+    if renderEngine == 'native' and installed_markdownify() != markdownifyVersion:
+        parser.error('--engine native makes the markup of markdownify %s, and markdownify %s '
+                     'is installed; install %s, or leave --engine out' % (
+                         markdownifyVersion, installed_markdownify() or '(of unknown version)',
+                         markdownifyVersion))
+    if args.macro_cache and renderEngine != 'native':
+        parser.error('--macro-cache caches what the native renderer makes; use it with --engine native')
+    if args.macro_cache:
+        fragmentCache = FragmentCache(args.macro_cache)
+    for module in args.macros:
+        macros.load(module)
+    if args.search_index:
+        if args.index_stopwords:
+            with open(args.index_stopwords, encoding='utf-8') as f:
+                indexStopwords = set(line.strip() for line in f
+                                     if line.strip() and not line.startswith('#'))
+        searchIndex = SearchIndex(args.index_version)
+        if not args.tar:
+            searchIndex.load(output_path('index'))
+    if args.tar and args.incremental:
+        parser.error('--incremental needs the pages from the last run, which --tar does not keep')
+    if args.tar and args.checkpoint:
+        parser.error('--checkpoint needs the pages already written, which --tar does not keep')
+    checkpoint = None
+    if args.checkpoint:
+        checkpoint = Checkpoint(args.checkpoint)
+        # the bodies have to outlast the run
+        if not args.body_store:
+            args.body_store = checkpoint.bodies_file
+    if args.tar:
+        writer = TarWriter(args.tar, threaded=args.writer_thread, debug_copy=args.debug_copy)
+    else:
+        writer = OutputWriter(threaded=args.writer_thread, debug_copy=args.debug_copy)
+    if args.user_names:
+        resolver = FileResolver(args.user_names)
+        userNames = NameCache()
+    else:
+        userNames = NameCache(args.name_cache, args.name_cache_ttl * 3600)
+        if args.no_ldap:
+            resolver = None
+        elif ldap is None:
+            print('python-ldap is not installed; using cached user names only')
+            resolver = None
+        else:
+            resolver = LdapResolver(args.ldap_server, args.ldap_base)
+
+    if args.zip:
+        with runReport.stage('index zip'):
+            exportZip = ExportZip(args.zip)
+        source = exportZip.signature()
+        entities = exportZip.open_entities
+    else:
+        source = export_signature('entities.xml')
+        entities = lambda: 'entities.xml'
+    if checkpoint:
+        with runReport.stage('load checkpoint'):
+            resuming = checkpoint.load_index(source)
+    else:
+        resuming = False
+    if not resuming:
+        load_export(args, resolver, source, entities)
+        if checkpoint:
+            with runReport.stage('save checkpoint'):
+                checkpoint.save_index(source)
+    with runReport.stage('link graph'):
+        build_link_graph(args.link_report)
+    try:
+        if args.affected_by:
+            for p in linkGraph.affected_by(find_page(args.affected_by)):
+                print('%s\t%s' % (p.id, p.pathname))
+            return
+        selection = Selection(args.root, args.status, not args.no_blog_posts, args.with_links)
+    except KeyError as e:
+        parser.error(e.args[0])
+    hashes = HashCache(args.hash_cache) if args.dedup_media else None
+    errors = export_pages(args.jobs, args.incremental, writer, selection, checkpoint,
+                          args.keep_going, args.history, hashes)
+
+    runReport.sections['export'] = source
+    runReport.sections['options'] = vars(args)
+    runReport.print_summary()
+    runReport.save(args.report)
+    print('Run report written to %s' % args.report)
+    if errors:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -2,3 +2,9 @@
 userMapping = {
     "confluenceid" : "localid",
 }
+
+# Hosts to replace in link URLs and link text
+urlRewrites = {
+    "ts.data61.csiro.au" : "trustworthy.systems",
+    "ssrg.nicta.com.au" : "trustworthy.systems",
+}
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# Checks that --history copes with historical versions that have no
+# BodyContent: runs extract.py on a small synthetic export from which
+# one page's older versions have lost their bodies, and checks that the
+# run succeeds and that page's attic and changelog have only the
+# versions that do have one. Exits with status 1 if not.
+#
+#   python3 tools/check_history.py
+import glob
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+
+repo = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+bodyContents = re.compile(r'<collection name="bodyContents"[^>]*>.*?</collection>')
+originalVersion = re.compile(r'<property name="originalVersion" class="Page" [^>]*><id name="id">(\d+)</id>')
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        subprocess.run([sys.executable, os.path.join(repo, 'benchmarks', 'synthetic_export.py'),
+                        '--pages', '10', '--history', '3', tmp], check=True, stdout=subprocess.DEVNULL)
+        entities = os.path.join(tmp, 'entities.xml')
+        with open(entities, encoding='utf-8') as f:
+            lines = f.read().split('\n')
+        # the older versions of the first page with any
+        owner = None
+        stripped = 0
+        for n, line in enumerate(lines):
+            m = line.startswith('<object class="Page"') and originalVersion.search(line)
+            if m and owner in (None, m.group(1)):
+                owner = m.group(1)
+                lines[n] = bodyContents.sub('', line)
+                stripped += 1
+        with open(entities, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines))
+        for name in ('extract.py', 'mappings.py'):
+            shutil.copy(os.path.join(repo, name), tmp)
+        run = subprocess.run([sys.executable, 'extract.py', '--no-ldap', '--history'],
+                             cwd=tmp, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                             universal_newlines=True)
+        changes = sorted(glob.glob(os.path.join(tmp, 'meta', '**', '*.changes'), recursive=True))
+        attic = glob.glob(os.path.join(tmp, 'attic', '**', '*.txt.gz'), recursive=True)
+        single = [c for c in changes if sum(1 for _ in open(c, encoding='utf-8')) == 1]
+    print('%d older versions without a body; extract.py exited with %s; '
+          '%d changelogs, %d of one version, %d attic files' % (
+              stripped, run.returncode, len(changes), len(single), len(attic)))
+    if run.returncode != 0:
+        print(run.stdout[-2000:])
+    # the page whose older versions have no body keeps only its latest
+    sys.exit(0 if stripped and run.returncode == 0 and len(single) == 1 else 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# Checks that extract.py's index_words() splits text into the words
+# DokuWiki's indexer (Indexer::tokenizer) gives for it, on a few texts
+# whose tokenization DokuWiki is known to give. Exits with status 1 if
+# any differ.
+#
+#   python3 tools/check_index_words.py
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import extract
+
+# text -> the words DokuWiki indexes for it, in any order
+KNOWN = [
+    ('see v1.2 of foo-bar and file.txt at ns:page and snake\\_case',
+     ['see', 'v1.2', 'foo-bar', 'file.txt', 'at', 'ns:page', 'snake', '_case']),
+    ('page\\_0\\_memory', ['page', '_0', '_memory']),
+    ('The Kernel, the kernel; THE KERNEL!', ['kernel', 'kernel', 'kernel']),
+    ('a 1 b 22 x* ** (c)', ['1', '22', 'x*', '**']),
+    ('line\none\ttab\rcr', ['line', 'one', 'tab', 'cr']),
+    ('soft\xadhyphen non\xa0breaking', ['softhyphen', 'non', 'breaking']),
+    ('[[:oldwiki:a_b|Link]] {{oldwiki:c.png?200}}',
+     [':oldwiki:a_b', 'link', 'oldwiki:c.png', '200']),
+    ('\u65e5\u672c\u8a9e text', ['\u65e5', '\u672c', '\u8a9e', 'text']),
+    ('Caf\u00e9 na\u00efve \u00c9T\u00c9', ['caf\u00e9', 'na\u00efve', '\u00e9t\u00e9']),
+]
+
+def expected_words(words):
+    found = {}
+    for word in words:
+        found[word] = found.get(word, 0) + 1
+    return found
+
+def main():
+    failed = 0
+    for text, words in KNOWN:
+        got = extract.index_words(text)
+        if got != expected_words(words):
+            failed += 1
+            print('%r:\n  expected %s\n  got      %s' % (text, expected_words(words), got))
+    print('%d of %d tokenizations differ' % (failed, len(KNOWN)))
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
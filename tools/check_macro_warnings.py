@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# Checks that what a --macros module's handlers warn about with
+# extract.warn() is printed with the page: runs extract.py, as a script,
+# on a small synthetic export with a module whose status handler warns.
+# Exits with status 1 if the warnings are not in its output.
+#
+#   python3 tools/check_macro_warnings.py
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+repo = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+PLUGIN = '''
+import extract
+
+def status(cc, page):
+    extract.warn('check: status macro in %s' % page.title)
+    return cc.get_text()
+
+def register_macros(registry):
+    registry.register('status', status)
+'''
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        subprocess.run([sys.executable, os.path.join(repo, 'benchmarks', 'synthetic_export.py'),
+                        '--pages', '20', '--macro-rate', '1', tmp], check=True, stdout=subprocess.DEVNULL)
+        for name in ('extract.py', 'mappings.py'):
+            shutil.copy(os.path.join(repo, name), tmp)
+        with open(os.path.join(tmp, 'warning_macros.py'), 'w') as f:
+            f.write(PLUGIN)
+        run = subprocess.run([sys.executable, 'extract.py', '--no-ldap', '--macros', 'warning_macros.py'],
+                             cwd=tmp, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                             universal_newlines=True)
+    warnings = [line for line in run.stdout.splitlines() if line.startswith('check: status macro in ')]
+    print('extract.py exited with %s; %d warnings from the macro module' % (run.returncode, len(warnings)))
+    sys.exit(0 if run.returncode == 0 and warnings else 1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# Differential test of extract.py's two rendering engines: converts
+# every page of an export both with markdownify and with the native
+# renderer, and reports the pages whose output differs. Exits with
+# status 1 if any do.
+#
+#   cd <export>; python3 <repo>/tools/diff_engines.py [--body-store FILE] [--show N]
+import argparse
+import difflib
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import extract
+
+def load(body_store):
+    if body_store:
+        extract.PageContent = extract.BodyStore(body_store)
+        if extract.PageContent.source() is not None:
+            extract.load_store(extract.PageContent)
+        else:
+            extract.load_tree('entities.xml', extract.PageContent)
+            extract.PageContent.finish(extract.export_signature('entities.xml'))
+    else:
+        extract.load_tree('entities.xml')
+    extract.build_hierarchy()
+
+def render_both(page):
+    body = extract.PageContent[page.bodyId]
+    start = time.perf_counter()
+    old = extract.md(extract.convert(body, page))
+    middle = time.perf_counter()
+    new = extract.renderer.render(extract.rewrite(body, page))
+    end = time.perf_counter()
+    return old, new, middle - start, end - middle
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the markdownify and native engines')
+    parser.add_argument('--body-store', metavar='FILE', help='read the export from a BodyStore')
+    parser.add_argument('--parser', choices=['html.parser', 'lxml', 'lxml-xml'], default='html.parser')
+    parser.add_argument('--show', type=int, default=3, metavar='N',
+                        help='print diffs of the first N differing pages')
+    args = parser.parse_args()
+    extract.soupParser = args.parser
+
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        load(args.body_store)
+        results = []
+        for p, depth in extract.hierarchy.walk():
+            if p.bodyId == '0' or not p.is_latest():
+                continue
+            results.append((p, ) + render_both(p))
+    finally:
+        sys.stdout = stdout
+
+    differ = [r for r in results if r[1] != r[2]]
+    for p, old, new, _, _ in differ[:args.show]:
+        sys.stdout.writelines(difflib.unified_diff(
+            old.splitlines(True), new.splitlines(True),
+            'markdownify/' + p.pathname, 'native/' + p.pathname))
+        print()
+    for p, _, _, _, _ in differ[args.show:]:
+        print('differs: ' + p.pathname)
+    markdownify_time = sum(r[3] for r in results)
+    native_time = sum(r[4] for r in results)
+    print('%s pages, %s differ' % (len(results), len(differ)))
+    if results:
+        print('markdownify %.2fs, native %.2fs (%.1fx)' % (
+            markdownify_time, native_time, markdownify_time / max(native_time, 1e-9)))
+    return 1 if differ else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# A tiny LDAPv3 server for testing extract.py's user-name lookups
+# without a real directory. It accepts anonymous binds and answers
+# searches with (uid=...) equality filters, ORed or ANDed together,
+# from a JSON {uid: name} or CSV uid,name file. Every entry has
+# 'uid' and 'cn' attributes.
+#
+#   python3 tools/ldap_stub.py names.csv --port 3890 &
+#   python3 extract.py --ldap-server ldap://localhost:3890
+import argparse
+import csv
+import json
+import socketserver
+
+# BER tags
+SEQUENCE = 0x30
+BIND_REQUEST = 0x60
+BIND_RESPONSE = 0x61
+UNBIND_REQUEST = 0x42
+SEARCH_REQUEST = 0x63
+SEARCH_RESULT_ENTRY = 0x64
+SEARCH_RESULT_DONE = 0x65
+ABANDON_REQUEST = 0x50
+FILTER_AND = 0xa0
+FILTER_OR = 0xa1
+FILTER_EQUALITY = 0xa3
+
+def encode_length(n):
+    if n < 0x80:
+        return bytes([n])
+    b = n.to_bytes((n.bit_length() + 7) // 8, 'big')
+    return bytes([0x80 | len(b)]) + b
+
+def tlv(tag, value):
+    return bytes([tag]) + encode_length(len(value)) + value
+
+def integer(n, tag=0x02):
+    return tlv(tag, n.to_bytes(max(1, (n.bit_length() + 8) // 8), 'big', signed=True))
+
+def octets(s):
+    if isinstance(s, str):
+        s = s.encode('utf-8')
+    return tlv(0x04, s)
+
+# Returns (tag, value, rest of data), or None if data is incomplete
+def decode(data):
+    if len(data) < 2:
+        return None
+    tag = data[0]
+    length = data[1]
+    offset = 2
+    if length & 0x80:
+        nbytes = length & 0x7f
+        if len(data) < 2 + nbytes:
+            return None
+        length = int.from_bytes(data[2:2 + nbytes], 'big')
+        offset += nbytes
+    if len(data) < offset + length:
+        return None
+    return tag, data[offset:offset + length], data[offset + length:]
+
+def decode_all(data):
+    items = []
+    while data:
+        tag, value, data = decode(data)
+        items.append((tag, value))
+    return items
+
+def result(tag, msgid, code=0):
+    return tlv(SEQUENCE, integer(msgid) + tlv(tag, integer(code, 0x0a) + octets('') + octets('')))
+
+# the uids an (|(uid=a)(uid=b)...) style filter asks for; None if
+# the filter is anything else, in which case every entry is returned
+def wanted_uids(tag, value):
+    if tag == FILTER_EQUALITY:
+        (_, attr), (_, val) = decode_all(value)
+        if attr.decode('utf-8').lower() == 'uid':
+            return set([val.decode('utf-8')])
+        return None
+    if tag in (FILTER_AND, FILTER_OR):
+        uids = set()
+        for t, v in decode_all(value):
+            sub = wanted_uids(t, v)
+            if sub is None:
+                return None
+            uids |= sub
+        return uids
+    return None
+
+def load_names(filename):
+    with open(filename, encoding='utf-8', newline='') as f:
+        if filename.endswith('.json'):
+            return json.load(f)
+        return dict(row[:2] for row in csv.reader(f) if len(row) >= 2)
+
+class LdapHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        data = b''
+        while True:
+            message = decode(data)
+            if message is None:
+                chunk = self.request.recv(65536)
+                if not chunk:
+                    return
+                data += chunk
+                continue
+            _, body, data = message
+            items = decode_all(body)
+            msgid = int.from_bytes(items[0][1], 'big', signed=True)
+            op, value = items[1]
+            if op == BIND_REQUEST:
+                self.request.sendall(result(BIND_RESPONSE, msgid))
+            elif op == SEARCH_REQUEST:
+                self.search(msgid, value)
+            elif op == UNBIND_REQUEST:
+                return
+            elif op != ABANDON_REQUEST:
+                # anything else is not supported: unwillingToPerform
+                self.request.sendall(result(op + 1, msgid, 53))
+
+    def search(self, msgid, value):
+        fields = decode_all(value)
+        base = fields[0][1].decode('utf-8')
+        uids = wanted_uids(*fields[6])
+        names = self.server.names
+        out = []
+        for uid in sorted(names if uids is None else uids & set(names)):
+            dn = 'uid=%s,%s' % (uid, base) if base else 'uid=%s' % uid
+            attrs = b''.join(
+                tlv(SEQUENCE, octets(k) + tlv(0x31, octets(v)))
+                for k, v in (('uid', uid), ('cn', names[uid])))
+            entry = tlv(SEARCH_RESULT_ENTRY, octets(dn) + tlv(SEQUENCE, attrs))
+            out.append(tlv(SEQUENCE, integer(msgid) + entry))
+        out.append(result(SEARCH_RESULT_DONE, msgid))
+        self.request.sendall(b''.join(out))
+
+class LdapServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, names):
+        socketserver.ThreadingTCPServer.__init__(self, address, LdapHandler)
+        self.names = names
+
+def main():
+    parser = argparse.ArgumentParser(description='Stub LDAP server for user-name lookups')
+    parser.add_argument('names', help='JSON {uid: name} or CSV uid,name file')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=3890)
+    args = parser.parse_args()
+    server = LdapServer((args.host, args.port), load_names(args.names))
+    print('Serving %d names on ldap://%s:%d' % (len(server.names), args.host, args.port))
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()